@@ -0,0 +1,60 @@
+"""initial schema
+
+Revision ID: 3f9a1c2e5b01
+Revises:
+Create Date: 2024-09-15 12:00:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "3f9a1c2e5b01"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases from before the migrations were made by create_all and have
+    # these tables already
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if "users" not in existing:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("username", sa.String()),
+            sa.Column("hashed_password", sa.String()),
+            sa.Column("is_admin", sa.Boolean()),
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_username", "users", ["username"], unique=True)
+    if "images" not in existing:
+        op.create_table(
+            "images",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("url", sa.String()),
+            sa.Column("description", sa.String()),
+            sa.Column("title", sa.String()),
+            sa.Column("description_page", sa.String()),
+            sa.Column("artist", sa.String()),
+        )
+        op.create_index("ix_images_id", "images", ["id"])
+        op.create_index("ix_images_url", "images", ["url"])
+    if "audios" not in existing:
+        op.create_table(
+            "audios",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("filename", sa.String()),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+            sa.Column("image_id", sa.Integer(), sa.ForeignKey("images.id")),
+            sa.Column("created_at", sa.DateTime()),
+        )
+        op.create_index("ix_audios_id", "audios", ["id"])
+        op.create_index("ix_audios_filename", "audios", ["filename"])
+
+
+def downgrade():
+    op.drop_table("audios")
+    op.drop_table("images")
+    op.drop_table("users")
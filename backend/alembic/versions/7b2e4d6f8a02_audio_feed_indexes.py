@@ -0,0 +1,36 @@
+"""audio feed indexes
+
+Revision ID: 7b2e4d6f8a02
+Revises: 3f9a1c2e5b01
+Create Date: 2024-09-20 12:00:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "7b2e4d6f8a02"
+down_revision = "3f9a1c2e5b01"
+branch_labels = None
+depends_on = None
+
+# Back the keyset pagination of the per-image and per-user audio feeds
+INDEXES = {
+    "ix_audios_image_created_id": ["image_id", "created_at", "id"],
+    "ix_audios_user_created_id": ["user_id", "created_at", "id"],
+}
+
+
+def upgrade():
+    # Servers before the migrations created these indexes at startup
+    existing = {
+        index["name"] for index in sa.inspect(op.get_bind()).get_indexes("audios")
+    }
+    for name, columns in INDEXES.items():
+        if name not in existing:
+            op.create_index(name, "audios", columns)
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, "audios")
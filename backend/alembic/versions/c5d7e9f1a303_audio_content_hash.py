@@ -0,0 +1,33 @@
+"""audio content hash
+
+Revision ID: c5d7e9f1a303
+Revises: 7b2e4d6f8a02
+Create Date: 2024-09-25 12:00:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "c5d7e9f1a303"
+down_revision = "7b2e4d6f8a02"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sha256 of the file, identical re-uploads reuse the existing row. Servers
+    # before the migrations added the column at startup.
+    inspector = sa.inspect(op.get_bind())
+    if "content_hash" not in {c["name"] for c in inspector.get_columns("audios")}:
+        op.add_column("audios", sa.Column("content_hash", sa.String(64)))
+    if "ix_audios_content_hash" not in {
+        index["name"] for index in inspector.get_indexes("audios")
+    }:
+        op.create_index("ix_audios_content_hash", "audios", ["content_hash"])
+
+
+def downgrade():
+    op.drop_index("ix_audios_content_hash", "audios")
+    with op.batch_alter_table("audios") as batch:
+        batch.drop_column("content_hash")
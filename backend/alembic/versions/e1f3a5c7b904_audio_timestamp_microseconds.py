@@ -0,0 +1,29 @@
+"""audio timestamps with microseconds
+
+Revision ID: e1f3a5c7b904
+Revises: c5d7e9f1a303
+Create Date: 2024-09-26 12:00:00
+
+"""
+
+from alembic import op
+
+revision = "e1f3a5c7b904"
+down_revision = "c5d7e9f1a303"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows dated by SQLite's CURRENT_TIMESTAMP are text in whole seconds, which
+    # sorts before the same second written by SQLAlchemy with microseconds and
+    # breaks the pagination cursors. Postgres stores real timestamps.
+    if op.get_bind().dialect.name == "sqlite":
+        op.execute(
+            "UPDATE audios SET created_at = created_at || '.000000' "
+            "WHERE length(created_at) = 19"
+        )
+
+
+def downgrade():
+    pass
@@ -0,0 +1,171 @@
+import mimetypes
+import os
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Lock
+from urllib.parse import quote
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from . import crud
+from .audio_uploads import UPLOADS_FOLDER, file_hash
+
+# Playback of uploaded audio. Uploads never change once stored, so responses
+# carry a strong ETag (the content hash), Last-Modified and an immutable
+# Cache-Control, conditional requests get a 304 and Range requests a 206.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# "x-accel-redirect" (nginx) or "x-sendfile" (Apache, lighttpd) hands the
+# body to the fronting proxy, Python only sends the headers. Empty serves the
+# file from here.
+AUDIO_SENDFILE = os.getenv("AUDIO_SENDFILE", "").lower()
+# Internal nginx location mapped to the uploads folder, for x-accel-redirect
+AUDIO_ACCEL_PREFIX = os.getenv("AUDIO_ACCEL_PREFIX", "/protected-uploads/")
+READ_BLOCK_SIZE = 64 * 1024
+# Stored filename and content hash per audio id, both never change
+AUDIO_CACHE_SIZE = int(os.getenv("AUDIO_CACHE_SIZE", 10000))
+
+audio_cache = OrderedDict()
+audio_cache_lock = Lock()
+
+
+def stored_audio(db, audio_id):
+    # Returns (filename, content_hash), None for unknown ids. Audios stored
+    # before content hashes were recorded get theirs on the first request.
+    with audio_cache_lock:
+        if audio_id in audio_cache:
+            audio_cache.move_to_end(audio_id)
+            return audio_cache[audio_id]
+    audio = crud.get_audio(db, audio_id=audio_id)
+    if audio is None:
+        return None
+    content_hash = audio.content_hash
+    if content_hash is None:
+        path = UPLOADS_FOLDER / audio.filename
+        if not path.exists():
+            return audio.filename, None
+        content_hash = file_hash(path)
+        crud.set_audio_content_hash(db, audio, content_hash)
+    with audio_cache_lock:
+        audio_cache[audio_id] = (audio.filename, content_hash)
+        if len(audio_cache) > AUDIO_CACHE_SIZE:
+            audio_cache.popitem(last=False)
+    return audio.filename, content_hash
+
+
+def forget_audio(audio_id):
+    with audio_cache_lock:
+        audio_cache.pop(audio_id, None)
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since and uses weak comparison
+        return if_none_match.strip() == "*" or etag in [
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        ]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and last_modified <= since
+    return False
+
+
+def requested_range(request, etag, size):
+    # Returns (start, end) inclusive for a single satisfiable byte range, None
+    # to send the whole file. Multiple ranges are answered with the whole file,
+    # players only ask for one.
+    header = request.headers.get("range", "")
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    first, _, last = header[len("bytes=") :].strip().partition("-")
+    try:
+        if first == "":
+            # Suffix range, the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size - 1)
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def audio_file_response(request: Request, db, audio_id: int):
+    stored = stored_audio(db, audio_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    filename, content_hash = stored
+    path = UPLOADS_FOLDER / filename
+    try:
+        stat = os.stat(path)
+    except OSError:
+        forget_audio(audio_id)
+        raise HTTPException(status_code=404, detail="Audio file not found")
+
+    etag = f'"{content_hash}"'
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename)[0] or "audio/ogg"
+    # Both headers are percent-encoded: nginx and mod_xsendfile decode them,
+    # and stored names may hold spaces, "#", "?", "%" or non-latin-1 letters
+    if AUDIO_SENDFILE == "x-accel-redirect":
+        # nginx answers Range requests itself from the internal location
+        headers["X-Accel-Redirect"] = AUDIO_ACCEL_PREFIX + quote(filename, safe="")
+        return Response(media_type=media_type, headers=headers)
+    if AUDIO_SENDFILE == "x-sendfile":
+        headers["X-Sendfile"] = quote(str(path.resolve()))
+        return Response(media_type=media_type, headers=headers)
+
+    byte_range = requested_range(request, etag, stat.st_size)
+    if byte_range is None:
+        return FileResponse(
+            path,
+            media_type=media_type,
+            filename=filename,
+            stat_result=stat,
+            headers=headers,
+        )
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_range(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
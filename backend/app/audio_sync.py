@@ -0,0 +1,119 @@
+import os
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from . import models
+from .audio_uploads import UPLOADS_FOLDER, file_hash, uploads_lock
+
+# Brings the audios table in line with the files in UPLOADS_FOLDER without
+# touching rows that are still valid, so audio ids stay stable.
+#   python -m app.audio_sync
+# Rows per INSERT/DELETE statement, stays below the bind parameter limits
+BATCH_SIZE = 5000
+
+
+def parse_audio_filename(filename):
+    # audio_{image_id}_{user_id}_{%Y%m%d_%H%M%S_%f}_{sha256}{extension}, see
+    # upload_audio in main.py
+    parts = filename.split("_")
+    if len(parts) < 4:
+        return None
+    try:
+        image_id, user_id = int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+    try:
+        created_at = datetime.strptime("_".join(parts[3:6]), "%Y%m%d_%H%M%S_%f")
+    except ValueError:
+        created_at = None
+    return image_id, user_id, created_at
+
+
+def reconcile_audio(db: Session, uploads_folder=UPLOADS_FOLDER):
+    # Runs of several server processes take turns, and uploads wait
+    with uploads_lock(uploads_folder):
+        return reconcile_locked(db, uploads_folder)
+
+
+def reconcile_locked(db, uploads_folder):
+    rows = {}
+    duplicates = []
+    for audio_id, filename in db.execute(
+        select(models.Audio.id, models.Audio.filename).order_by(models.Audio.id)
+    ):
+        if filename in rows:
+            duplicates.append(audio_id)
+        else:
+            rows[filename] = audio_id
+
+    user_ids = set(db.scalars(select(models.User.id)))
+    image_ids = set(db.scalars(select(models.Image.id)))
+    files = set()
+    missing = []
+    skipped = 0
+    with os.scandir(uploads_folder) as entries:
+        for entry in entries:
+            if not entry.name.startswith("audio_") or not entry.is_file():
+                continue
+            files.add(entry.name)
+            if entry.name in rows:
+                continue
+            parsed = parse_audio_filename(entry.name)
+            if (
+                parsed is None
+                or parsed[0] not in image_ids
+                or parsed[1] not in user_ids
+            ):
+                print(f"Skipping audio file {entry.name}")
+                skipped += 1
+                continue
+            image_id, user_id, created_at = parsed
+            missing.append(
+                {
+                    "filename": entry.name,
+                    "image_id": image_id,
+                    "user_id": user_id,
+                    # Older uploads without a timestamp use the file's mtime
+                    "created_at": created_at
+                    or datetime.fromtimestamp(entry.stat().st_mtime),
+                    "content_hash": file_hash(entry.path),
+                }
+            )
+
+    # New ids follow upload order
+    missing.sort(key=lambda row: row["created_at"])
+    orphaned = [
+        audio_id for filename, audio_id in rows.items() if filename not in files
+    ]
+    unchanged = len(rows) - len(orphaned)
+    orphaned += duplicates
+    try:
+        for start in range(0, len(missing), BATCH_SIZE):
+            db.execute(insert(models.Audio), missing[start : start + BATCH_SIZE])
+        for start in range(0, len(orphaned), BATCH_SIZE):
+            db.query(models.Audio).filter(
+                models.Audio.id.in_(orphaned[start : start + BATCH_SIZE])
+            ).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    summary = {
+        "added": len(missing),
+        "removed": len(orphaned),
+        "unchanged": unchanged,
+        "skipped": skipped,
+    }
+    print(f"Reconciled audio files: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        reconcile_audio(db)
+    finally:
+        db.close()
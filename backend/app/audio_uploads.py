@@ -0,0 +1,388 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import struct
+import subprocess
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from fastapi import HTTPException, Request
+from multipart.multipart import MultipartParser, parse_options_header
+from sqlalchemy import select
+from . import models
+
+# Audio uploads are parsed straight from the request stream into a temporary
+# file in UPLOADS_FOLDER, hashed on the way and renamed into place once
+# complete, so nothing is spooled twice and partial files never show up.
+UPLOADS_FOLDER = Path("uploads")
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", 20 * 1024 * 1024))
+MAX_AUDIO_SECONDS = float(os.getenv("MAX_AUDIO_SECONDS", 300))
+# Containers audio_duration cannot read are measured with ffprobe if it is
+# installed, uploads whose duration is still unknown are rejected
+FFPROBE_TIMEOUT = 10
+# Data is written to disk in blocks of this size, off the event loop
+WRITE_BLOCK_SIZE = 1024 * 1024
+# Room for the multipart boundaries and the other form fields
+MULTIPART_OVERHEAD = 64 * 1024
+
+known_image_ids = None
+image_ids_lock = Lock()
+
+
+def image_exists(db, image_id):
+    # Positive answers come from a cached id set. Ids missing from it are
+    # looked up, they may have been added by another server process.
+    global known_image_ids
+
+    with image_ids_lock:
+        if known_image_ids is None:
+            known_image_ids = set(db.scalars(select(models.Image.id)))
+        if image_id in known_image_ids:
+            return True
+    if db.get(models.Image, image_id) is None:
+        return False
+    remember_image(image_id)
+    return True
+
+
+def remember_image(image_id):
+    with image_ids_lock:
+        if known_image_ids is not None:
+            known_image_ids.add(image_id)
+
+
+@contextmanager
+def uploads_lock(uploads_folder=UPLOADS_FOLDER, shared=False):
+    # Uploads hold it shared from moving their file into place until its row
+    # is inserted, reconcile_audio holds it exclusively. So a reconciliation
+    # never sees a file whose row is still on its way, in any server process.
+    with open(Path(uploads_folder).with_suffix(".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def audio_duration(path):
+    # Seconds of audio in Ogg (Opus, Vorbis), WAV, WebM and MP4 files, read
+    # from the headers and the last Ogg page or WebM block. None for anything
+    # else.
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(4096)
+        if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+            position, byte_rate = 12, None
+            while position + 8 <= len(head):
+                chunk_id = head[position : position + 4]
+                chunk_size = int.from_bytes(head[position + 4 : position + 8], "little")
+                if chunk_id == b"fmt ":
+                    byte_rate = int.from_bytes(
+                        head[position + 16 : position + 20], "little"
+                    )
+                elif chunk_id == b"data" and byte_rate:
+                    return min(chunk_size, size - position - 8) / byte_rate
+                position += 8 + chunk_size + chunk_size % 2
+            return None
+        if head[:4] == EBML_HEADER:
+            return webm_duration(f)
+        if head[4:8] == b"ftyp":
+            return mp4_duration(f, size)
+
+        if head[:4] != b"OggS":
+            return None
+        pre_skip = 0
+        if b"OpusHead" in head:
+            start = head.index(b"OpusHead")
+            rate = 48000
+            pre_skip = int.from_bytes(head[start + 10 : start + 12], "little")
+        elif b"\x01vorbis" in head:
+            start = head.index(b"\x01vorbis")
+            rate = int.from_bytes(head[start + 12 : start + 16], "little")
+        else:
+            return None
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or not rate:
+        return None
+    granule = int.from_bytes(tail[last_page + 6 : last_page + 14], "little")
+    return max(0, granule - pre_skip) / rate
+
+
+# WebM (Matroska) element ids
+EBML_HEADER = b"\x1a\x45\xdf\xa3"
+WEBM_SEGMENT = 0x18538067
+WEBM_INFO = 0x1549A966
+WEBM_TIMECODE_SCALE = 0x2AD7B1
+WEBM_DURATION = 0x4489
+WEBM_CLUSTER = 0x1F43B675
+WEBM_CLUSTER_TIMECODE = 0xE7
+WEBM_BLOCK_GROUP = 0xA0
+WEBM_BLOCK = 0xA1
+WEBM_SIMPLE_BLOCK = 0xA3
+
+
+def read_vint(f, marker=False):
+    # EBML variable length integer, returns the value and its length in bytes.
+    # Element ids keep their length marker.
+    first = f.read(1)
+    if not first or first[0] == 0:
+        return None, 0
+    length = 9 - first[0].bit_length()
+    rest = f.read(length - 1)
+    if len(rest) < length - 1:
+        return None, 0
+    value = first[0] if marker else first[0] & (0xFF >> length)
+    return int.from_bytes(bytes([value]) + rest, "big"), length
+
+
+def webm_duration(f):
+    # The Duration of the segment info if there is one. Browsers recording
+    # with MediaRecorder leave it out, then the time of the last block counts.
+    # The elements holding the blocks are read inline, so streams written with
+    # unknown sizes work too.
+    f.seek(0)
+    scale, duration, cluster, last = 1_000_000, None, 0, None
+    while True:
+        element, _ = read_vint(f, marker=True)
+        data_size, length = read_vint(f)
+        if element is None or data_size is None:
+            break
+        if element in (WEBM_SEGMENT, WEBM_INFO, WEBM_CLUSTER, WEBM_BLOCK_GROUP):
+            continue
+        if data_size == (1 << 7 * length) - 1:
+            break
+        start = f.tell()
+        if element == WEBM_TIMECODE_SCALE:
+            scale = int.from_bytes(f.read(data_size), "big")
+        elif element == WEBM_DURATION and data_size in (4, 8):
+            duration = struct.unpack(
+                ">f" if data_size == 4 else ">d", f.read(data_size)
+            )[0]
+        elif element == WEBM_CLUSTER_TIMECODE:
+            cluster = int.from_bytes(f.read(data_size), "big")
+        elif element in (WEBM_SIMPLE_BLOCK, WEBM_BLOCK):
+            read_vint(f)
+            timecode = int.from_bytes(f.read(2), "big", signed=True)
+            last = max(last or 0, cluster + timecode)
+        f.seek(start + data_size)
+    if duration:
+        return duration * scale / 1e9
+    return None if last is None else last * scale / 1e9
+
+
+def mp4_boxes(f, start, end):
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        box_size, header_size = int.from_bytes(header[:4], "big"), 8
+        if box_size == 1:
+            box_size, header_size = int.from_bytes(f.read(8), "big"), 16
+        elif box_size == 0:
+            box_size = end - position
+        if box_size < header_size:
+            return
+        yield header[4:8], position + header_size, position + box_size
+        position += box_size
+
+
+def mp4_duration(f, size):
+    # Duration of the movie header, or of the fragments for fragmented files
+    for kind, start, end in mp4_boxes(f, 0, size):
+        if kind != b"moov":
+            continue
+        timescale, duration = None, 0
+        for kind, start, end in list(mp4_boxes(f, start, end)):
+            if kind == b"mvhd":
+                f.seek(start)
+                version = f.read(4)[0]
+                f.seek(start + (20 if version == 1 else 12))
+                timescale = int.from_bytes(f.read(4), "big")
+                duration = int.from_bytes(f.read(8 if version == 1 else 4), "big")
+            elif kind == b"mvex":
+                for kind, start, end in list(mp4_boxes(f, start, end)):
+                    if kind == b"mehd" and not duration:
+                        f.seek(start)
+                        version = f.read(4)[0]
+                        duration = int.from_bytes(
+                            f.read(8 if version == 1 else 4), "big"
+                        )
+        # All bits set means unknown
+        if timescale and 0 < duration < (1 << 32) - 1:
+            return duration / timescale
+    return None
+
+
+def ffprobe_duration(path):
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "csv=p=0",
+                str(path),
+            ],
+            capture_output=True,
+            text=True,
+            timeout=FFPROBE_TIMEOUT,
+        )
+        return float(result.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def measure_duration(path):
+    duration = audio_duration(path)
+    if duration is None:
+        duration = ffprobe_duration(path)
+    return duration
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class AudioUpload:
+    # Receives the file field of a multipart body: temporary path, original
+    # filename, size and sha256 of the content.
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.path = UPLOADS_FOLDER / f".upload-{uuid.uuid4().hex}.tmp"
+        self.filename = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.file = None
+        self.pending = []
+        self.pending_size = 0
+        self.header_field = b""
+        self.header_value = b""
+        self.disposition = b""
+        self.in_field = False
+
+    def on_part_begin(self):
+        self.disposition = b""
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if self.header_field.lower() == b"content-disposition":
+            self.disposition = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.disposition)
+        self.in_field = (
+            options.get(b"name") == self.field_name.encode()
+            and b"filename" in options
+            and self.filename is None
+        )
+        if self.in_field:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(self, data, start, end):
+        if not self.in_field:
+            return
+        self.size += end - start
+        if self.size > MAX_AUDIO_BYTES:
+            raise UploadTooLarge()
+        chunk = data[start:end]
+        self.sha256.update(chunk)
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+
+    def on_part_end(self):
+        self.in_field = False
+
+    async def flush(self, force=False):
+        # Writes the buffered data once a block is full, or all of it on force
+        if not force and self.pending_size < WRITE_BLOCK_SIZE:
+            return
+        if self.file is None:
+            self.file = await asyncio.to_thread(open, self.path, "wb")
+        block, self.pending, self.pending_size = b"".join(self.pending), [], 0
+        await asyncio.to_thread(self.file.write, block)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+async def receive_audio(request: Request, field_name="audio"):
+    content_length = int(request.headers.get("content-length") or 0)
+    if content_length > MAX_AUDIO_BYTES + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail="Audio file too large")
+    content_type, options = parse_options_header(
+        request.headers.get("content-type", "")
+    )
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart upload")
+
+    upload = AudioUpload(field_name)
+    callbacks = {
+        name: getattr(upload, name)
+        for name in (
+            "on_part_begin",
+            "on_header_field",
+            "on_header_value",
+            "on_header_end",
+            "on_headers_finished",
+            "on_part_data",
+            "on_part_end",
+        )
+    }
+    parser = MultipartParser(options[b"boundary"], callbacks)
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            await upload.flush()
+        parser.finalize()
+        if upload.filename is None:
+            raise HTTPException(status_code=400, detail=f"No {field_name} file sent")
+        await upload.flush(force=True)
+        upload.close()
+
+        duration = await asyncio.to_thread(measure_duration, upload.path)
+        if duration is None:
+            raise HTTPException(
+                status_code=415,
+                detail="Unsupported audio format, the duration cannot be read",
+            )
+        if duration > MAX_AUDIO_SECONDS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Audio longer than {MAX_AUDIO_SECONDS:g} seconds",
+            )
+    except UploadTooLarge:
+        upload.discard()
+        raise HTTPException(status_code=413, detail="Audio file too large")
+    except BaseException:
+        upload.discard()
+        raise
+    return upload
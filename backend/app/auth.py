@@ -1,3 +1,8 @@
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
@@ -10,17 +15,123 @@ from .database import get_db
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# bcrypt cost factor, every +1 doubles the time per hash
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# Password hashing gets its own small pool, so a burst of logins cannot take
+# every CPU from the other requests. Beyond HASHING_MAX_PENDING queued or
+# running hashes, requests are turned away with a 429.
+HASHING_WORKERS = int(os.getenv("HASHING_WORKERS", 2))
+HASHING_MAX_PENDING = int(os.getenv("HASHING_MAX_PENDING", HASHING_WORKERS * 8))
+HASHING_RETRY_AFTER = 1
+# Resolved users are cached for this many seconds, 0 looks them up every time
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+PRINCIPAL_CACHE_SIZE = 4096
+# Trust the id and admin flag in the token instead of looking the user up.
+# Tokens then stay valid until they expire, even if the user changes.
+AUTH_CLAIMS_ONLY = os.getenv("AUTH_CLAIMS_ONLY", "0") == "1"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+hashing_executor = ThreadPoolExecutor(
+    max_workers=HASHING_WORKERS, thread_name_prefix="bcrypt"
+)
+hashing_lock = Lock()
+hashing_pending = 0
+hashing_rejected = 0
+hashing_completed = 0
+
+principal_cache = OrderedDict()  # username -> (expiry, Principal)
+principal_cache_lock = Lock()
+
+
+class Principal:
+    # What the endpoints need to know about the authenticated user, without
+    # holding on to a database session.
+
+    def __init__(self, id, username, is_admin):
+        self.id = id
+        self.username = username
+        self.is_admin = is_admin
+
+
+def cached_principal(username):
+    with principal_cache_lock:
+        entry = principal_cache.get(username)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del principal_cache[username]
+            return None
+        principal_cache.move_to_end(username)
+        return entry[1]
+
+
+def cache_principal(principal):
+    if PRINCIPAL_CACHE_TTL <= 0:
+        return
+    with principal_cache_lock:
+        principal_cache[principal.username] = (
+            time.monotonic() + PRINCIPAL_CACHE_TTL,
+            principal,
+        )
+        principal_cache.move_to_end(principal.username)
+        while len(principal_cache) > PRINCIPAL_CACHE_SIZE:
+            principal_cache.popitem(last=False)
+
+
+def invalidate_principal(username):
+    # Call whenever a user's password or admin flag changes. Other server
+    # processes notice after PRINCIPAL_CACHE_TTL at the latest.
+    with principal_cache_lock:
+        principal_cache.pop(username, None)
+
+
+def run_hashing(function, *args):
+    # Called from the request threads, which wait here for a hashing worker.
+    # bcrypt releases the GIL while hashing.
+    global hashing_pending, hashing_rejected, hashing_completed
+
+    with hashing_lock:
+        if hashing_pending >= HASHING_MAX_PENDING:
+            hashing_rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts at once, try again",
+                headers={"Retry-After": str(HASHING_RETRY_AFTER)},
+            )
+        hashing_pending += 1
+    try:
+        return hashing_executor.submit(function, *args).result()
+    finally:
+        with hashing_lock:
+            hashing_pending -= 1
+            hashing_completed += 1
+
+
+def hashing_stats():
+    return {
+        "workers": HASHING_WORKERS,
+        "rounds": BCRYPT_ROUNDS,
+        "pending": hashing_pending,
+        "max_pending": HASHING_MAX_PENDING,
+        "completed": hashing_completed,
+        "rejected": hashing_rejected,
+    }
+
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return run_hashing(pwd_context.verify, plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return run_hashing(pwd_context.hash, password)
+
+
+def token_claims(user):
+    return {"sub": user.username, "uid": user.id, "adm": user.is_admin}
 
 
 def create_access_token(data: dict):
@@ -46,7 +157,16 @@ def get_current_user(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+
+    if AUTH_CLAIMS_ONLY and "uid" in payload and "adm" in payload:
+        return Principal(payload["uid"], username, bool(payload["adm"]))
+    principal = cached_principal(username)
+    if principal is not None:
+        return principal
+
     user = crud.get_user_by_username(db, username=username)
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal(user.id, user.username, user.is_admin)
+    cache_principal(principal)
+    return principal
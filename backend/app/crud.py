@@ -1,16 +1,11 @@
+import base64
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from . import models, schemas, auth
-from json import load
-
-
-def get_all_artwork_embeddings():
-    with open("../embedding_generator/art_embeddings.json", "r") as f:
-        embeddings = load(f)
-
-    return [
-        {"id": image_name.split(".")[0], "embedding": embedding}
-        for image_name, embedding in embeddings.items()
-    ]
+from . import models, schemas, auth, audio_uploads
+from json import dumps, loads
 
 
 def get_user(db: Session, user_id: int):
@@ -29,6 +24,15 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    auth.invalidate_principal(db_user.username)
+    return db_user
+
+
+def change_password(db: Session, user_id: int, new_password: str):
+    db_user = get_user(db, user_id)
+    db_user.hashed_password = auth.get_password_hash(new_password)
+    db.commit()
+    auth.invalidate_principal(db_user.username)
     return db_user
 
 
@@ -42,9 +46,60 @@ def create_image(db: Session, image: schemas.ImageCreate, image_id: int):
     db.add(db_image)
     db.commit()
     db.refresh(db_image)
+    audio_uploads.remember_image(db_image.id)
     return db_image
 
 
+def upsert_images(db: Session, images: list):
+    # Writes a batch of schemas.Image with one INSERT ... ON CONFLICT DO UPDATE.
+    # Rows that already hold the same values are left out of the statement.
+    # Returns the created, updated and unchanged counts.
+    records = {image.id: image.dict() for image in images}
+    columns = [name for name in schemas.ImageCreate.model_fields]
+    existing = {
+        row.id: row
+        for row in db.execute(
+            select(models.Image.id, *(getattr(models.Image, c) for c in columns)).where(
+                models.Image.id.in_(records)
+            )
+        )
+    }
+    created = updated = 0
+    changed = []
+    for image_id, record in records.items():
+        row = existing.get(image_id)
+        if row is None:
+            created += 1
+        elif any(getattr(row, c) != record[c] for c in columns):
+            updated += 1
+        else:
+            continue
+        changed.append(record)
+
+    if changed:
+        dialect_insert = (
+            postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+        )
+        statement = dialect_insert(models.Image).values(changed)
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.Image.id],
+            set_={c: statement.excluded[c] for c in columns},
+        )
+        try:
+            db.execute(statement)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    for image_id in records:
+        audio_uploads.remember_image(image_id)
+    return {
+        "created": created,
+        "updated": updated,
+        "unchanged": len(records) - created - updated,
+    }
+
+
 def get_image(db: Session, image_id: int):
     return db.query(models.Image).filter(models.Image.id == image_id).first()
 
@@ -61,15 +116,60 @@ def get_audio(db: Session, audio_id: int):
     return db.query(models.Audio).filter(models.Audio.id == audio_id).first()
 
 
-def get_audios_for_image(db: Session, image_id: int, skip: int = 0, limit: int = 10):
+def set_audio_content_hash(db: Session, audio: models.Audio, content_hash: str):
+    audio.content_hash = content_hash
+    db.commit()
+
+
+def get_audio_by_hash(db: Session, user_id: int, image_id: int, content_hash: str):
     return (
         db.query(models.Audio)
-        .filter(models.Audio.image_id == image_id)
-        .offset(skip)
-        .limit(limit)
-        .all()
+        .filter(
+            models.Audio.user_id == user_id,
+            models.Audio.image_id == image_id,
+            models.Audio.content_hash == content_hash,
+        )
+        .first()
+    )
+
+
+def encode_cursor(audio: models.Audio):
+    position = dumps([audio.created_at.isoformat(), audio.id])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    # Raises ValueError for cursors that were not made by encode_cursor
+    try:
+        created_at, audio_id = loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(audio_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def get_audio_page(query, cursor: str = None, limit: int = 10):
+    # Keyset pagination ordered by (created_at, id), every page is an index
+    # range scan no matter how deep it is. Returns the audios and the cursor
+    # of the next page, None on the last page.
+    if cursor is not None:
+        query = query.filter(
+            tuple_(models.Audio.created_at, models.Audio.id) > decode_cursor(cursor)
+        )
+    audios = (
+        query.order_by(models.Audio.created_at, models.Audio.id).limit(limit + 1).all()
     )
+    if len(audios) <= limit:
+        return audios, None
+    return audios[:limit], encode_cursor(audios[limit - 1])
+
+
+def get_audios_for_image(
+    db: Session, image_id: int, cursor: str = None, limit: int = 10
+):
+    query = db.query(models.Audio).filter(models.Audio.image_id == image_id)
+    return get_audio_page(query, cursor, limit)
 
 
-def get_audios_for_user(db: Session, user_id: int):
-    return db.query(models.Audio).filter(models.Audio.user_id == user_id).all()
+def get_audios_for_user(db: Session, user_id: int, cursor: str = None, limit: int = 10):
+    query = db.query(models.Audio).filter(models.Audio.user_id == user_id)
+    return get_audio_page(query, cursor, limit)
@@ -0,0 +1,264 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from threading import Lock, RLock
+import numpy as np
+from fastapi import HTTPException, Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Artwork embeddings of the embedding generator, loaded once into a float32
+# matrix and reloaded when the file changes. Every representation is encoded
+# and compressed once per file version and served with a strong ETag.
+EMBEDDINGS_FILE = Path(
+    os.getenv("ARTWORK_EMBEDDINGS_FILE", "../embedding_generator/art_embeddings.json")
+)
+# Representations smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+FORMATS = ("json", "base64", "float16", "binary", "ids")
+# Neighbours precomputed per artwork for the "related artworks" lookups
+SIMILAR_TABLE_K = int(os.getenv("SIMILAR_TABLE_K", 20))
+# From this many artworks on, searches go through an approximate FLANN
+# index instead of scoring every artwork, 0 always scores every artwork
+SIMILAR_ANN_MIN_SIZE = int(os.getenv("SIMILAR_ANN_MIN_SIZE", 50000))
+SIMILAR_BLOCK_SIZE = 1024
+FLANN_INDEX_KMEANS = 2
+
+loaded = None
+load_lock = Lock()
+
+
+class ArtworkEmbeddings:
+    def __init__(self, ids, matrix, json_payload, version, source):
+        self.ids = ids
+        self.matrix = matrix
+        self.version = version
+        self.source = source  # (size, mtime_ns) of the file
+        self.json_payload = json_payload
+        self.representations = {}
+        self.lock = Lock()
+        # The ANN index and the neighbour table are built once, under their
+        # own lock so a build does not hold up representation(). Reentrant,
+        # building the table builds the index.
+        self.build_lock = RLock()
+        # Unit rows, so cosine similarity is a dot product
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True) if matrix.size else 1
+        self.normalized = matrix / np.maximum(norms, 1e-12)
+        self.rows = {artwork_id: row for row, artwork_id in enumerate(ids)}
+        self.ann_index = None
+        self.neighbour_table = None
+
+    @classmethod
+    def load(cls, path):
+        stat = path.stat()
+        data = path.read_bytes()
+        embeddings = json.loads(data)
+        ids = [image_name.split(".")[0] for image_name in embeddings]
+        matrix = np.array(list(embeddings.values()), dtype=np.float32)
+        if len(ids) == 0:
+            matrix = matrix.reshape(0, 0)
+        # The original values, in the response format the frontend expects
+        json_payload = json.dumps(
+            [
+                {"id": artwork_id, "embedding": embedding}
+                for artwork_id, embedding in zip(ids, embeddings.values())
+            ],
+            separators=(",", ":"),
+        ).encode()
+        version = hashlib.sha256(data).hexdigest()[:32]
+        return cls(ids, matrix, json_payload, version, (stat.st_size, stat.st_mtime_ns))
+
+    def encode(self, format):
+        # Returns the body and media type of a representation
+        if format == "json":
+            return self.json_payload, "application/json"
+        if format == "ids":
+            return json.dumps(self.ids).encode(), "application/json"
+        if format == "binary":
+            # Row i belongs to artwork i of format=ids
+            return self.matrix.astype("<f4").tobytes(), "application/octet-stream"
+        dtype = "<f2" if format == "float16" else "<f4"
+        payload = {
+            "ids": self.ids,
+            "dtype": "float16" if format == "float16" else "float32",
+            "shape": list(self.matrix.shape),
+            "data": base64.b64encode(self.matrix.astype(dtype).tobytes()).decode(),
+        }
+        return json.dumps(payload).encode(), "application/json"
+
+    def representation(self, format, encoding):
+        key = (format, encoding)
+        with self.lock:
+            if key not in self.representations:
+                body, media_type = self.encode(format)
+                if encoding == "br":
+                    body = brotli.compress(body)
+                elif encoding == "gzip":
+                    body = gzip.compress(body, compresslevel=6, mtime=0)
+                suffix = f"-{encoding}" if encoding else ""
+                etag = f'"{self.version}-{format}{suffix}"'
+                self.representations[key] = (body, media_type, etag)
+            return self.representations[key]
+
+    def uses_ann(self):
+        return 0 < SIMILAR_ANN_MIN_SIZE <= len(self.ids)
+
+    def search(self, vectors, k):
+        # Returns the rows of the k most similar artworks for each unit
+        # vector, best first, and their cosine similarities.
+        k = min(k, len(self.ids))
+        if k == 0:
+            empty = np.empty((len(vectors), 0))
+            return empty.astype(np.int32), empty.astype(np.float32)
+        if self.uses_ann():
+            if self.ann_index is None:
+                with self.build_lock:
+                    if self.ann_index is None:
+                        self.ann_index = self.build_ann_index()
+            rows, distances = self.ann_index.knnSearch(
+                np.ascontiguousarray(vectors, dtype=np.float32), k, params={}
+            )
+            # Squared L2 distance between unit vectors is 2 - 2 cos
+            return rows.reshape(-1, k), 1 - distances.reshape(-1, k) / 2
+
+        scores = vectors @ self.normalized.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1),
+        )
+
+    def build_ann_index(self):
+        import cv2
+
+        return cv2.flann_Index(
+            self.normalized,
+            dict(algorithm=FLANN_INDEX_KMEANS, branching=32, iterations=7),
+        )
+
+    def build_neighbour_table(self):
+        # One extra neighbour, every artwork finds itself first
+        k = min(SIMILAR_TABLE_K + 1, len(self.ids))
+        rows = np.empty((len(self.ids), k), dtype=np.int32)
+        scores = np.empty((len(self.ids), k), dtype=np.float32)
+        for start in range(0, len(self.ids), SIMILAR_BLOCK_SIZE):
+            end = start + SIMILAR_BLOCK_SIZE
+            rows[start:end], scores[start:end] = self.search(
+                self.normalized[start:end], k
+            )
+        return rows, scores
+
+    def similar_to(self, artwork_id, k):
+        if artwork_id not in self.rows:
+            return None
+        row = self.rows[artwork_id]
+        if k <= SIMILAR_TABLE_K:
+            if self.neighbour_table is None:
+                with self.build_lock:
+                    if self.neighbour_table is None:
+                        self.neighbour_table = self.build_neighbour_table()
+            rows, scores = (table[row] for table in self.neighbour_table)
+        else:
+            rows, scores = (
+                result[0]
+                for result in self.search(self.normalized[row : row + 1], k + 1)
+            )
+        return [
+            {"id": self.ids[other], "similarity": float(score)}
+            for other, score in zip(rows, scores)
+            if other != row
+        ][:k]
+
+    def similar_to_vector(self, vector, k):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        rows, scores = (result[0] for result in self.search(vector[None, :], k))
+        return [
+            {"id": self.ids[row], "similarity": float(score)}
+            for row, score in zip(rows, scores)
+        ]
+
+
+def get_embeddings():
+    global loaded
+
+    try:
+        stat = EMBEDDINGS_FILE.stat()
+    except OSError:
+        raise HTTPException(status_code=404, detail="Artwork embeddings not found")
+    with load_lock:
+        if loaded is None or loaded.source != (stat.st_size, stat.st_mtime_ns):
+            loaded = ArtworkEmbeddings.load(EMBEDDINGS_FILE)
+            print(f"Loaded {len(loaded.ids)} artwork embeddings")
+        return loaded
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, parameters = item.strip().partition(";")
+        if parameters.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00"):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def embeddings_response(request: Request, format: str):
+    if format not in FORMATS:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown format, use one of {', '.join(FORMATS)}"
+        )
+    embeddings = get_embeddings()
+
+    encoding = None
+    accepted = accepted_encodings(request)
+    if len(embeddings.json_payload) >= COMPRESS_MIN_SIZE:
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+    body, media_type, etag = embeddings.representation(format, encoding)
+
+    headers = {
+        "ETag": etag,
+        # Clients keep their copy and revalidate it with If-None-Match
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    # If-None-Match uses the weak comparison, W/ prefixes added by proxies
+    # do not matter
+    if if_none_match.strip() == "*" or etag in [
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    ]:
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if format == "binary":
+        headers["X-Embedding-Shape"] = ",".join(map(str, embeddings.matrix.shape))
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def similar_artworks(artwork_id: str, k: int):
+    similar = get_embeddings().similar_to(artwork_id, k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Artwork not found")
+    return similar
+
+
+def similar_to_embedding(embedding: list, k: int):
+    embeddings = get_embeddings()
+    if len(embedding) != embeddings.matrix.shape[1]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Expected an embedding of length {embeddings.matrix.shape[1]}",
+        )
+    return embeddings.similar_to_vector(embedding, k)
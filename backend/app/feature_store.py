@@ -0,0 +1,305 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+
+# A feature store directory holds one directory per generation and the symlink
+# current, which points to the generation in use:
+#   descriptors.f32  float32 (rows, 128), the descriptors of all paintings
+#   keypoints.f32    float32 (rows, 7), see KEYPOINT_FIELDS
+#   offsets.i64      int64 (paintings + 1), painting i owns rows offsets[i]:offsets[i+1]
+#   manifest.json    format version, painting names, row count, checksums and
+#                    for every painting the size, mtime and hash of its image
+#   verified         generation whose checksums were already verified
+# The data files of a generation never change. A new store is written to a
+# new directory and current swapped to it in one rename, so readers never see
+# files of two generations.
+# The data files are opened with np.memmap, so reading a store costs no
+# private memory. Matching does not use the mapped pages: FLANN copies the
+# descriptors it indexes, so each recognition worker holds a private copy of
+# them next to its KD-tree (see recognition_pool.py).
+FORMAT_VERSION = 2
+DESCRIPTOR_SIZE = 128
+KEYPOINT_FIELDS = ("x", "y", "size", "angle", "response", "octave", "class_id")
+
+MANIFEST_FILE = "manifest.json"
+DESCRIPTORS_FILE = "descriptors.f32"
+KEYPOINTS_FILE = "keypoints.f32"
+OFFSETS_FILE = "offsets.i64"
+VERIFIED_FILE = "verified"
+CURRENT_LINK = "current"
+GENERATION_PREFIX = "gen-"
+
+
+class FeatureStoreError(Exception):
+    pass
+
+
+def keypoints_to_array(keypoints):
+    return np.array(
+        [
+            (*kp.pt, kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+            for kp in keypoints
+        ],
+        dtype=np.float32,
+    ).reshape(-1, len(KEYPOINT_FIELDS))
+
+
+def content_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@contextmanager
+def store_lock(lock_file):
+    # Held while a store is migrated or refreshed, so of all server processes
+    # and crawler runs only one extracts and writes features at a time.
+    with open(lock_file, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _checksum(array):
+    if array.size == 0:
+        return 0
+    return zlib.crc32(np.ascontiguousarray(array).view(np.uint8))
+
+
+def _open_array(path, dtype, shape):
+    expected_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if not path.exists() or path.stat().st_size != expected_size:
+        raise FeatureStoreError(f"{path.name} does not match the manifest")
+    if expected_size == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _generation(checksums):
+    return "".join(
+        f"{checksums[name]:08x}"
+        for name in (DESCRIPTORS_FILE, KEYPOINTS_FILE, OFFSETS_FILE)
+    )
+
+
+def _resolve(path):
+    # The generation directory a store directory points to, a generation
+    # directory itself is returned as it is
+    try:
+        return path / os.readlink(path / CURRENT_LINK)
+    except OSError:
+        return path
+
+
+def _mark_verified(path, generation):
+    stamp = path / (VERIFIED_FILE + f".tmp-{os.getpid()}")
+    try:
+        stamp.write_text(generation)
+        os.replace(stamp, path / VERIFIED_FILE)
+    except OSError:
+        pass
+
+
+class FeatureStore:
+    def __init__(self, path, manifest, descriptors, keypoints, offsets):
+        self.path = Path(path)
+        self.manifest = manifest
+        self.painting_names = manifest["paintings"]
+        self.files = manifest["files"]
+        self.descriptors = descriptors
+        self.keypoints = keypoints
+        self.offsets = offsets
+        self.root = self.path
+
+    @classmethod
+    def open(cls, path, verify=True, extractor=None):
+        # path is a store directory or one of its generation directories
+        root = Path(path)
+        path = _resolve(root)
+        try:
+            with open(path / MANIFEST_FILE) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise FeatureStoreError(f"Cannot read manifest: {e}")
+
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise FeatureStoreError(
+                f"Unsupported format version {manifest.get('format_version')}"
+            )
+        if extractor is not None and manifest.get("extractor") != extractor:
+            raise FeatureStoreError("Features were computed with other settings")
+
+        rows = manifest["rows"]
+        paintings = len(manifest["paintings"])
+        descriptors = _open_array(
+            path / DESCRIPTORS_FILE, np.float32, (rows, DESCRIPTOR_SIZE)
+        )
+        keypoints = _open_array(
+            path / KEYPOINTS_FILE, np.float32, (rows, len(KEYPOINT_FIELDS))
+        )
+        offsets = _open_array(path / OFFSETS_FILE, np.int64, (paintings + 1,))
+        if offsets[0] != 0 or offsets[-1] != rows or np.any(np.diff(offsets) < 0):
+            raise FeatureStoreError("Offsets table is inconsistent")
+
+        store = cls(path, manifest, descriptors, keypoints, offsets)
+        store.root = root
+        if verify and not store.is_verified():
+            store.verify()
+        return store
+
+    def is_current(self):
+        # False once another process has written a new store in its place
+        return _resolve(self.root) == self.path
+
+    def is_verified(self):
+        # Reading every page for the checksums is only done once per
+        # generation, not by every process that opens the store.
+        try:
+            return (self.path / VERIFIED_FILE).read_text() == self.generation
+        except OSError:
+            return False
+
+    def verify(self):
+        checksums = self.manifest["checksums"]
+        for name, array in (
+            (DESCRIPTORS_FILE, self.descriptors),
+            (KEYPOINTS_FILE, self.keypoints),
+            (OFFSETS_FILE, self.offsets),
+        ):
+            if _checksum(array) != checksums[name]:
+                raise FeatureStoreError(f"Checksum mismatch in {name}")
+        _mark_verified(self.path, self.generation)
+
+    def __len__(self):
+        return len(self.painting_names)
+
+    @property
+    def generation(self):
+        # Identifies the store contents, changes whenever the store is rewritten
+        return _generation(self.manifest["checksums"])
+
+    @property
+    def keypoint_counts(self):
+        return np.diff(self.offsets)
+
+    def painting_descriptors(self, painting):
+        return self.descriptors[self.offsets[painting] : self.offsets[painting + 1]]
+
+    def painting_keypoints(self, painting):
+        return self.keypoints[self.offsets[painting] : self.offsets[painting + 1]]
+
+    def painting_is_intact(self, painting):
+        # Per painting check, used to salvage a store whose file checksum fails.
+        name = self.painting_names[painting]
+        crc = zlib.crc32(
+            np.ascontiguousarray(self.painting_keypoints(painting)).view(np.uint8),
+            _checksum(self.painting_descriptors(painting)),
+        )
+        return crc == self.files[name]["crc32"]
+
+
+class FeatureStoreWriter:
+    # Streams paintings into a new generation directory and points the store
+    # to it on close. The generation before stays, so workers that were just
+    # handed its path can still open it; older ones are removed (processes
+    # that map their files keep them until they let go).
+
+    def __init__(self, path, extractor=None):
+        self.root = Path(path)
+        self.extractor = extractor
+        self.painting_names = []
+        self.files = {}
+        self.offsets = [0]
+        self.checksums = {DESCRIPTORS_FILE: 0, KEYPOINTS_FILE: 0}
+        self.name = GENERATION_PREFIX + uuid.uuid4().hex
+        self.path = self.root / f".tmp-{self.name}"
+        self.path.mkdir(parents=True)
+        self.outputs = {
+            name: open(self.path / name, "wb")
+            for name in (DESCRIPTORS_FILE, KEYPOINTS_FILE)
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, painting_name, keypoints, descriptors, source=None):
+        if descriptors is None:
+            descriptors = np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32)
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float32)
+        if len(keypoints) != len(descriptors):
+            raise FeatureStoreError(f"{painting_name}: keypoint count mismatch")
+
+        painting_crc = 0
+        for name, array in (
+            (DESCRIPTORS_FILE, descriptors),
+            (KEYPOINTS_FILE, keypoints),
+        ):
+            data = array.view(np.uint8) if array.size else b""
+            self.outputs[name].write(data)
+            self.checksums[name] = zlib.crc32(data, self.checksums[name])
+            painting_crc = zlib.crc32(data, painting_crc)
+
+        self.painting_names.append(painting_name)
+        # source describes the image file: size, mtime_ns and sha256
+        self.files[painting_name] = {**(source or {}), "crc32": painting_crc}
+        self.offsets.append(self.offsets[-1] + len(descriptors))
+
+    def close(self):
+        for f in self.outputs.values():
+            f.close()
+
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        offsets.tofile(self.path / OFFSETS_FILE)
+        self.checksums[OFFSETS_FILE] = _checksum(offsets)
+
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "extractor": self.extractor,
+            "rows": int(offsets[-1]),
+            "paintings": self.painting_names,
+            "files": self.files,
+            "checksums": self.checksums,
+        }
+        with open(self.path / MANIFEST_FILE, "w") as f:
+            json.dump(manifest, f)
+        # The checksums were computed from the data as it was written
+        _mark_verified(self.path, _generation(self.checksums))
+
+        generation_dir = self.root / self.name
+        os.rename(self.path, generation_dir)
+        self.path = generation_dir
+        previous = _resolve(self.root)
+        link = self.root / f".{CURRENT_LINK}-{self.name}"
+        os.symlink(self.name, link)
+        os.replace(link, self.root / CURRENT_LINK)
+
+        for stale in self.root.glob(GENERATION_PREFIX + "*"):
+            if stale not in (generation_dir, previous):
+                shutil.rmtree(stale, ignore_errors=True)
+        # Files of a store written before there were generation directories
+        for stale in self.root.iterdir():
+            if stale.is_file() and not stale.is_symlink():
+                stale.unlink(missing_ok=True)
+
+    def abort(self):
+        for f in self.outputs.values():
+            f.close()
+        shutil.rmtree(self.path, ignore_errors=True)
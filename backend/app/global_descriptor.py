@@ -0,0 +1,154 @@
+import json
+import os
+from pathlib import Path
+import cv2
+import numpy as np
+
+# Global image descriptors for the prefilter stage: VLAD over RootSIFT, using
+# a small codebook trained on the gallery descriptors. Query and gallery go
+# through the same SIFT features, so no extra model is needed.
+PREFILTER_CLUSTERS = int(os.getenv("PREFILTER_CLUSTERS", 64))
+# Photos show the painting with wall, frame and furniture around it. Only the
+# keypoints inside this central fraction of the query contribute to its global
+# descriptor, the gallery images are tight crops already.
+PREFILTER_CENTER = float(os.getenv("PREFILTER_CENTER", 0.4))
+CODEBOOK_SAMPLE = 100_000
+
+EMBEDDINGS_FILE = "embeddings.f32"
+CODEBOOK_FILE = "codebook.f32"
+EMBEDDINGS_MANIFEST = "embeddings.json"
+
+
+def root_sift(descriptors):
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    descriptors = descriptors / (np.abs(descriptors).sum(axis=1, keepdims=True) + 1e-7)
+    return np.sqrt(descriptors)
+
+
+def train_codebook(descriptors, clusters=PREFILTER_CLUSTERS):
+    # A fixed stride sample and seed keep the codebook reproducible for the
+    # same store contents.
+    step = max(1, len(descriptors) // CODEBOOK_SAMPLE)
+    sample = root_sift(descriptors[::step])
+    clusters = min(clusters, len(sample))
+    cv2.setRNGSeed(0)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, centers = cv2.kmeans(
+        sample, clusters, None, criteria, 1, cv2.KMEANS_PP_CENTERS
+    )
+    return centers.astype(np.float32)
+
+
+def assign(descriptors, codebook):
+    distances = (
+        -2.0 * descriptors @ codebook.T
+        + np.einsum("ij,ij->i", codebook, codebook)[None, :]
+    )
+    return np.argmin(distances, axis=1)
+
+
+def vlad(descriptors, codebook):
+    result = np.zeros(codebook.shape, dtype=np.float32)
+    if descriptors is not None and len(descriptors):
+        descriptors = root_sift(descriptors)
+        clusters = assign(descriptors, codebook)
+        np.add.at(result, clusters, descriptors)
+        result -= np.bincount(clusters, minlength=len(codebook))[:, None] * codebook
+    result = result.ravel()
+    # Power and L2 normalisation
+    result = np.sign(result) * np.sqrt(np.abs(result))
+    return result / (np.linalg.norm(result) + 1e-7)
+
+
+class EmbeddingIndex:
+    def __init__(self, codebook, embeddings):
+        self.codebook = codebook
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, store):
+        if len(store.descriptors) == 0:
+            return cls(
+                np.zeros((1, 128), dtype=np.float32),
+                np.zeros((len(store), 128), dtype=np.float32),
+            )
+        codebook = train_codebook(store.descriptors)
+        embeddings = np.stack(
+            [
+                vlad(store.painting_descriptors(painting), codebook)
+                for painting in range(len(store))
+            ]
+        )
+        return cls(codebook, embeddings)
+
+    @classmethod
+    def load(cls, store_dir, generation):
+        store_dir = Path(store_dir)
+        try:
+            with open(store_dir / EMBEDDINGS_MANIFEST) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("generation") != generation:
+            return None
+        clusters, paintings = manifest["clusters"], manifest["paintings"]
+        codebook = np.fromfile(store_dir / CODEBOOK_FILE, dtype=np.float32)
+        if paintings == 0:
+            return cls(codebook.reshape(clusters, 128), np.empty((0, clusters * 128)))
+        embeddings = np.memmap(
+            store_dir / EMBEDDINGS_FILE,
+            dtype=np.float32,
+            mode="r",
+            shape=(paintings, clusters * 128),
+        )
+        return cls(codebook.reshape(clusters, 128), embeddings)
+
+    def save(self, store_dir, generation):
+        store_dir = Path(store_dir)
+        suffix = f".tmp-{os.getpid()}"
+        self.codebook.tofile(store_dir / (CODEBOOK_FILE + suffix))
+        np.ascontiguousarray(self.embeddings, dtype=np.float32).tofile(
+            store_dir / (EMBEDDINGS_FILE + suffix)
+        )
+        with open(store_dir / (EMBEDDINGS_MANIFEST + suffix), "w") as f:
+            json.dump(
+                {
+                    "generation": generation,
+                    "clusters": len(self.codebook),
+                    "paintings": len(self.embeddings),
+                },
+                f,
+            )
+        for name in (CODEBOOK_FILE, EMBEDDINGS_FILE, EMBEDDINGS_MANIFEST):
+            os.replace(store_dir / (name + suffix), store_dir / name)
+
+    def embed(self, descriptors):
+        return vlad(descriptors, self.codebook)
+
+    def embed_query(self, points, descriptors, image_shape):
+        height, width = image_shape[:2]
+        central = (np.abs(points[:, 0] - width / 2) <= PREFILTER_CENTER * width / 2) & (
+            np.abs(points[:, 1] - height / 2) <= PREFILTER_CENTER * height / 2
+        )
+        if not central.any():
+            central[:] = True
+        return vlad(descriptors[central], self.codebook)
+
+    def top_k(self, query_embedding, k):
+        # Cosine similarity, both sides are L2 normalised
+        scores = self.embeddings @ query_embedding
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return top, scores[top]
+
+
+def ensure_embeddings(store):
+    index = EmbeddingIndex.load(store.path, store.generation)
+    if index is None:
+        print("Building prefilter embeddings")
+        index = EmbeddingIndex.build(store)
+        index.save(store.path, store.generation)
+    return index
@@ -1,20 +1,35 @@
+import asyncio
 from pathlib import Path
 import random
 import pickle
 from fastapi import HTTPException, File, UploadFile
-import cv2
 import os
 import numpy as np
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from .feature_store import (
+    FeatureStore,
+    FeatureStoreError,
+    FeatureStoreWriter,
+    content_hash,
+    keypoints_to_array,
+    store_lock,
+)
+from .global_descriptor import ensure_embeddings
+from .result_cache import perceptual_hash, result_cache
+from . import preprocessing, recognition_pool, warmup
 
 # Global variables
-CACHE_FILE = "paintings_cache.pkl"
+LEGACY_CACHE_FILE = "paintings_cache.pkl"
+FEATURE_STORE_DIR = Path("feature_store")
+STORE_LOCK_FILE = Path("feature_store.lock")
 PAINTINGS_FOLDER = Path("../crawler/belvedere_images")
-cached_paintings = {}
-FLANN_INDEX_KDTREE = 1
-index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-search_params = dict(checks=50)
-flann = cv2.FlannBasedMatcher(index_params, search_params)
+# Most images accepted by one batch recognition request
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 64))
+EXTRACTOR = preprocessing.extractor()
+feature_store = None
+refresh_lock = Lock()
+load_lock = Lock()
 
 
 async def test_find_similar_artwork():
@@ -33,79 +48,186 @@ async def test_find_similar_artwork():
     return result
 
 
-def keypoints_to_list(keypoints):
-    return [
-        (kp.pt, kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
-        for kp in keypoints
-    ]
+def migrate_legacy_cache():
+    # Convert a paintings_cache.pkl from older versions instead of running SIFT
+    # over every painting again.
+    print("Converting legacy feature cache")
+    with open(LEGACY_CACHE_FILE, "rb") as f:
+        cached_data = pickle.load(f)
+    with FeatureStoreWriter(FEATURE_STORE_DIR, extractor=EXTRACTOR) as writer:
+        for painting_file, data in cached_data.items():
+            keypoints = np.array(
+                [(*kp[0], *kp[1:]) for kp in data["keypoints"]], dtype=np.float32
+            )
+            writer.add(Path(painting_file).name, keypoints, data["descriptors"])
+    os.remove(LEGACY_CACHE_FILE)
 
 
-def list_to_keypoints(keypoints_list):
-    return [
-        cv2.KeyPoint(
-            x=kp[0][0],
-            y=kp[0][1],
-            size=kp[1],
-            angle=kp[2],
-            response=kp[3],
-            octave=kp[4],
-            class_id=kp[5],
-        )
-        for kp in keypoints_list
+def use_feature_store(store):
+    # The index itself is built by the recognition workers, they are handed
+    # the generation directory of the store and never see a newer one.
+    global feature_store
+
+    if recognition_pool.PREFILTER_TOP_K > 0:
+        ensure_embeddings(store)
+    feature_store = store
+    result_cache.clear(store.generation)
+    # Also when a request loaded the store after the warm-up failed
+    warmup.mark_ready("features")
+    print(f"Using feature store with {len(store.descriptors)} descriptors")
+
+
+def open_feature_store():
+    # Returns the stored features that can be reused, salvaging the intact
+    # paintings of a store that fails its checksum.
+    try:
+        return FeatureStore.open(FEATURE_STORE_DIR, extractor=EXTRACTOR)
+    except FeatureStoreError as e:
+        print(f"Feature store unusable ({e})")
+    try:
+        store = FeatureStore.open(FEATURE_STORE_DIR, verify=False, extractor=EXTRACTOR)
+    except FeatureStoreError:
+        return None
+    store.painting_names = [
+        name if store.painting_is_intact(i) else None
+        for i, name in enumerate(store.painting_names)
     ]
+    intact = len([name for name in store.painting_names if name is not None])
+    print(f"Salvaged {intact} of {len(store)} paintings from the feature store")
+    return store
 
 
-def load_or_compute_features():
-    global cached_paintings
+def extract_painting_features(painting_file):
+    print(f"Processing {painting_file.name}")
+    painting_image = preprocessing.load(painting_file)
+    if painting_image is None:
+        print(f"Failed to load image: {painting_file.name}")
+        return None
+    kp, des = preprocessing.extract_features(painting_image)
+    return keypoints_to_array(kp), des
 
-    if os.path.exists(CACHE_FILE):
-        print("Loading cached features")
-        try:
-            with open(CACHE_FILE, "rb") as f:
-                cached_data = pickle.load(f)
-            for painting_file, data in cached_data.items():
-                cached_paintings[painting_file] = (
-                    list_to_keypoints(data["keypoints"]),
-                    data["descriptors"],
-                )
-            return
-        except (EOFError, pickle.UnpicklingError, KeyError):
-            print("Cache file is corrupted. Recomputing features.")
-            os.remove(CACHE_FILE)
-
-    print("Computing features for all paintings")
-    sift = cv2.SIFT_create()
-
-    def process_image(painting_file):
-        print(f"Processing {painting_file.name}")
-        painting_image = cv2.imread(str(painting_file), cv2.IMREAD_GRAYSCALE)
-        if painting_image is None:
-            print(f"Failed to load image: {painting_file.name}")
-            return None
-        kp, des = sift.detectAndCompute(painting_image, None)
-        return painting_file, kp, des
 
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(process_image, painting_file)
-            for painting_file in PAINTINGS_FOLDER.glob("*.jpeg")
-        ]
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                painting_file, kp, des = result
-                cached_paintings[painting_file] = (kp, des)
+def refresh_features(progress=None):
+    # Brings the feature store in line with PAINTINGS_FOLDER. Only images that
+    # were added or whose content changed are run through SIFT.
+    with refresh_lock, store_lock(STORE_LOCK_FILE):
+        store = open_feature_store()
+        stored = {}
+        if store is not None:
+            stored = {
+                name: painting
+                for painting, name in enumerate(store.painting_names)
+                if name is not None
+            }
 
-    try:
-        with open(CACHE_FILE, "wb") as f:
-            pickle_data = {
-                k: {"keypoints": keypoints_to_list(v[0]), "descriptors": v[1]}
-                for k, v in cached_paintings.items()
+        sources = {}
+        changed = []
+        rehashed = 0
+        with os.scandir(PAINTINGS_FOLDER) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".jpeg") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                previous = store.files[entry.name] if entry.name in stored else {}
+                if previous and all(
+                    previous.get(key) == value for key, value in source.items()
+                ):
+                    source["sha256"] = previous["sha256"]
+                else:
+                    # Size or mtime differ, only the content hash can tell if
+                    # the features are stale. Converted legacy entries have no
+                    # hash yet and are trusted.
+                    source["sha256"] = content_hash(entry.path)
+                    rehashed += 1
+                    if entry.name not in stored or (
+                        previous.get("sha256", source["sha256"]) != source["sha256"]
+                    ):
+                        changed.append(entry.name)
+                sources[entry.name] = source
+
+        removed = [name for name in stored if name not in sources]
+        summary = {
+            "added": len([name for name in changed if name not in stored]),
+            "changed": len([name for name in changed if name in stored]),
+            "removed": len(removed),
+            "unchanged": len(sources) - len(changed),
+        }
+        up_to_date = (
+            store is not None
+            and not rehashed
+            and not removed
+            and len(stored) == len(store)
+        )
+        if up_to_date:
+            # Nothing to write, just make sure this store is the one in use
+            if feature_store is None or not feature_store.is_current():
+                use_feature_store(store)
+            return summary
+
+        print(f"Refreshing features: {summary}")
+        extracted = {}
+        with ThreadPoolExecutor() as executor:
+            futures = {
+                executor.submit(
+                    extract_painting_features, PAINTINGS_FOLDER / name
+                ): name
+                for name in changed
             }
-            pickle.dump(pickle_data, f)
+            for future in as_completed(futures):
+                extracted[futures[future]] = future.result()
+                if progress is not None:
+                    progress(len(extracted), len(futures))
+
+        with FeatureStoreWriter(FEATURE_STORE_DIR, extractor=EXTRACTOR) as writer:
+            for name in sorted(sources):
+                if name in extracted:
+                    if extracted[name] is None:
+                        continue
+                    keypoints, descriptors = extracted[name]
+                else:
+                    painting = stored[name]
+                    keypoints = store.painting_keypoints(painting)
+                    descriptors = store.painting_descriptors(painting)
+                writer.add(name, keypoints, descriptors, source=sources[name])
         print("Features cached successfully")
-    except Exception as e:
-        print(f"Failed to cache features: {str(e)}")
+
+        use_feature_store(FeatureStore.open(FEATURE_STORE_DIR, extractor=EXTRACTOR))
+        return summary
+
+
+def load_or_compute_features(progress=None):
+    # Only the first call in a process loads anything, later ones return None.
+    with load_lock:
+        if feature_store is not None:
+            return None
+
+        with store_lock(STORE_LOCK_FILE):
+            if os.path.exists(LEGACY_CACHE_FILE):
+                try:
+                    migrate_legacy_cache()
+                except (EOFError, pickle.UnpicklingError, KeyError, ValueError):
+                    print("Legacy cache file is corrupted. Ignoring it.")
+                    os.remove(LEGACY_CACHE_FILE)
+
+        print("Loading cached features")
+        return refresh_features(progress)
+
+
+def current_feature_store():
+    # Loads the features on first use and switches to a store that another
+    # server process has written in the meantime.
+    if feature_store is None:
+        load_or_compute_features()
+    elif not feature_store.is_current():
+        with refresh_lock:
+            try:
+                store = FeatureStore.open(FEATURE_STORE_DIR, extractor=EXTRACTOR)
+            except FeatureStoreError as e:
+                print(f"Keeping the current feature store ({e})")
+            else:
+                use_feature_store(store)
+    return feature_store
 
 
 async def find_similar_artwork_endpoint(image: UploadFile = File(...)):
@@ -113,37 +235,100 @@ async def find_similar_artwork_endpoint(image: UploadFile = File(...)):
 
     # Read the image file into memory
     image_bytes = await image.read()
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    query_image = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-
-    if query_image is None:
+    store = await asyncio.to_thread(current_feature_store)
+    generation = store.generation
+    image_hash = await asyncio.to_thread(perceptual_hash, image_bytes)
+    if image_hash is None:
         raise HTTPException(status_code=400, detail="Invalid image file")
 
-    sift = cv2.SIFT_create()
-    query_kp, query_des = sift.detectAndCompute(query_image, None)
-    print(f"Query image keypoints: {len(query_kp)}")
+    result = result_cache.get(image_hash, generation)
+    if result is not None:
+        print(f"Cached result: {result}")
+        return result
 
-    def match_painting(painting_data):
-        painting_file, (painting_kp, painting_des) = painting_data
-        matches = flann.knnMatch(query_des, painting_des, k=2)
-        good_matches = [m for m, n in matches if m.distance < 0.7 * n.distance]
-        similarity_score = len(good_matches) / max(len(query_kp), len(painting_kp))
-        return painting_file, similarity_score
+    result = await recognition_pool.run(
+        recognition_pool.recognize,
+        image_bytes,
+        str(store.path.resolve()),
+        generation,
+    )
 
-    with ThreadPoolExecutor() as executor:
-        results = list(executor.map(match_painting, cached_paintings.items()))
+    if result is None:
+        raise HTTPException(status_code=400, detail="Invalid image file")
 
-    best_match, best_score = max(results, key=lambda x: x[1])
+    print(f"Query image keypoints: {result.pop('keypoints')}")
+    result_cache.put(image_hash, generation, result)
+    best_match, best_score = result["similar_artwork_id"], result["similarity"]
 
     if best_match:
-        print(
-            f"Final result: Best match {best_match.stem} with similarity {best_score}"
-        )
-        return {"similar_artwork_id": best_match.stem, "similarity": best_score}
+        print(f"Final result: Best match {best_match} with similarity {best_score}")
     else:
         print("No match found")
-        return {"similar_artwork_id": None, "similarity": 0.0}
+    return result
+
 
+async def find_similar_artworks_batch_endpoint(images: list[UploadFile] = File(...)):
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BATCH_MAX_IMAGES} images per request"
+        )
+    print(f"Received batch of {len(images)} images")
+
+    store = await asyncio.to_thread(current_feature_store)
+    generation = store.generation
+    image_bytes = [await image.read() for image in images]
+    image_hashes = await asyncio.gather(
+        *(asyncio.to_thread(perceptual_hash, data) for data in image_bytes)
+    )
+    results = [
+        None if image_hash is None else result_cache.get(image_hash, generation)
+        for image_hash in image_hashes
+    ]
+    pending = [
+        i
+        for i, image_hash in enumerate(image_hashes)
+        if image_hash is not None and results[i] is None
+    ]
+
+    if pending:
+        # Extraction is spread over the workers in one job each, matching
+        # runs in a single job so all queries share one index search.
+        chunks = [
+            pending[i :: recognition_pool.RECOGNITION_WORKERS]
+            for i in range(min(len(pending), recognition_pool.RECOGNITION_WORKERS))
+        ]
+        extracted = await asyncio.gather(
+            *(
+                recognition_pool.run(
+                    recognition_pool.extract_batch, [image_bytes[i] for i in chunk]
+                )
+                for chunk in chunks
+            )
+        )
+        features = {}
+        for chunk, chunk_features in zip(chunks, extracted):
+            features.update(zip(chunk, chunk_features))
+        matched = await recognition_pool.run(
+            recognition_pool.match_batch,
+            [features[i] for i in pending],
+            str(store.path.resolve()),
+            generation,
+        )
+        for i, result in zip(pending, matched):
+            if result is not None:
+                result.pop("keypoints")
+                result_cache.put(image_hashes[i], generation, result)
+            results[i] = result
 
-# Load features when the module is imported
-load_or_compute_features()
+    response = []
+    for image, result in zip(images, results):
+        if result is None:
+            result = {
+                "similar_artwork_id": None,
+                "similarity": 0.0,
+                "error": "Invalid image file",
+            }
+        response.append({"filename": image.filename, **result})
+    found = [r for r in results if r is not None and r["similar_artwork_id"]]
+    print(f"Batch matched {len(found)} of {len(images)} images")
+    return response
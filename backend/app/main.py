@@ -6,23 +6,31 @@ from fastapi import (
     File,
     UploadFile,
     Query,
+    Response,
+    Request,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from sqlalchemy.orm import Session
 import sqlalchemy
-from . import crud, models, schemas, auth
+from . import crud, schemas, auth, warmup
+from .audio_files import audio_file_response
+from .audio_sync import reconcile_audio
+from .audio_uploads import UPLOADS_FOLDER, image_exists, receive_audio, uploads_lock
+from .embeddings import embeddings_response, similar_artworks, similar_to_embedding
 from datetime import datetime
-from .database import engine, get_db
-import shutil
+from typing import Optional
+from .database import get_db
+import asyncio
 import os
-from .image_detection import (
-    load_or_compute_features,
-    find_similar_artwork_endpoint,
-)
+import re
+from pathlib import Path
 
+# OpenCV and the feature index are imported by the warm-up task or the first
+# request needing them (see .image_detection), not when the app is imported.
 
-models.Base.metadata.create_all(bind=engine)
+# The schema is created and upgraded by the migrations (alembic upgrade head),
+# once before the server processes start.
 
 app = FastAPI()
 
@@ -32,12 +40,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Next-Cursor",
+        "ETag",
+        "X-Embedding-Shape",
+        "Content-Range",
+        "Accept-Ranges",
+    ],
 )
 
 
 @app.on_event("startup")
 async def startup_event():
-    load_or_compute_features()
     db = next(get_db())
     admin_username = os.getenv("ADMIN_USERNAME", "admin")
     admin_password = os.getenv("ADMIN_PASSWORD", "secret!password")
@@ -45,48 +59,140 @@ async def startup_event():
     if not existing_admin:
         crud.create_admin_user(db, admin_username, admin_password)
 
-    reload_audio_database(db)
+    warmup.start("features", load_features)
+    # Requests do not depend on it, /readyz only reports it
+    warmup.start("audio", reload_audio_files, required=False)
     # Run the test function
     # print("Running test function...")
     # test_result = await test_find_similar_artwork()
     # print(f"Test result: {test_result}")
 
 
-def reload_audio_database(db: Session):
-    # Delete all existing audio entries
-    db.query(models.Audio).delete()
-    db.commit()
+@app.on_event("shutdown")
+def shutdown_event():
+    from . import recognition_pool
 
-    # Get all audio files from the uploads folder
-    uploads_folder = "uploads"
-    audio_files = [f for f in os.listdir(uploads_folder) if f.startswith("audio_")]
+    recognition_pool.shutdown()
 
-    # Reload audio files into the database
-    for audio_file in audio_files:
-        # Extract information from the filename
-        parts = audio_file.split("_")
-        if len(parts) >= 4:
-            image_id = int(parts[1])
-            user_id = int(parts[2])
 
-            # Create new audio entry
-            audio_create = schemas.AudioCreate(filename=audio_file, image_id=image_id)
-            crud.create_audio(db=db, audio=audio_create, user_id=user_id)
+def load_features():
+    from .image_detection import load_or_compute_features
 
-    print(f"Reloaded {len(audio_files)} audio files into the database.")
+    load_or_compute_features(progress=warmup.subsystem("features").progress)
+
+
+def reload_audio_files():
+    db = next(get_db())
+    try:
+        reconcile_audio(db)
+    finally:
+        db.close()
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    ready = warmup.is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "subsystems": {
+                name: subsystem.as_dict()
+                for name, subsystem in warmup.subsystems.items()
+            },
+        },
+    )
 
 
 @app.post("/find-similar-artwork", response_model=schemas.SimilarArtworkResponse)
 async def find_similar_artwork(image: UploadFile = File(...)):
+    warmup.require("features")
+    from .image_detection import find_similar_artwork_endpoint
+
     return await find_similar_artwork_endpoint(image)
 
 
+@app.post(
+    "/find-similar-artwork/batch", response_model=list[schemas.BatchArtworkResult]
+)
+async def find_similar_artworks_batch(images: list[UploadFile] = File(...)):
+    warmup.require("features")
+    from .image_detection import find_similar_artworks_batch_endpoint
+
+    return await find_similar_artworks_batch_endpoint(images)
+
+
+@app.get("/metrics")
+def get_metrics():
+    from .result_cache import result_cache
+
+    return {
+        "result_cache": result_cache.stats(),
+        "password_hashing": auth.hashing_stats(),
+    }
+
+
+@app.post("/admin/refresh-features", response_model=schemas.FeatureRefresh)
+def refresh_painting_features(
+    current_user: auth.Principal = Depends(auth.get_current_user),
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    warmup.require("features")
+    from .image_detection import refresh_features
+
+    return refresh_features()
+
+
+@app.post("/admin/reconcile-audio", response_model=schemas.AudioReconcile)
+def reconcile_audio_files(
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user),
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    summary = reconcile_audio(db)
+    warmup.mark_ready("audio")
+    return summary
+
+
+# Written by the crawler's post-processing (crawler/postprocess.py)
+THUMBNAILS_FOLDER = Path("../crawler/belvedere_thumbnails")
+# Images per /images/bulk request, each is written in a single statement
+BULK_MAX_IMAGES = int(os.getenv("BULK_MAX_IMAGES", 1000))
+
+
+# Declared before /images/{image_id}, which would match "bulk" too
+@app.post("/images/bulk", response_model=schemas.ImageBulkResult)
+def upsert_images(
+    images: list[schemas.Image],
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user),
+):
+    # Creates or updates the images by id, re-running the crawler is safe
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if len(images) > BULK_MAX_IMAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {BULK_MAX_IMAGES} images per request",
+        )
+    return crud.upsert_images(db, images)
+
+
 @app.post("/images/{image_id}", response_model=schemas.Image)
 async def create_image(
     image_id: int,
     image: schemas.ImageCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
 ):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Not authorized")
@@ -97,6 +203,32 @@ async def create_image(
         raise HTTPException(status_code=409, detail="Item already exists")
 
 
+@app.get("/images/{image_id}/thumbnail")
+def get_image_thumbnail(image_id: int, width: int = 640):
+    # Thumbnails made by the crawler's post-processing, the smallest one at
+    # least `width` wide, else the largest there is
+    try:
+        widths = sorted(
+            int(entry.name)
+            for entry in os.scandir(THUMBNAILS_FOLDER)
+            if entry.name.isdigit()
+        )
+    except FileNotFoundError:
+        widths = []
+    candidates = [w for w in widths if w >= width] + [
+        w for w in reversed(widths) if w < width
+    ]
+    for candidate in candidates:
+        path = THUMBNAILS_FOLDER / str(candidate) / f"{image_id}.jpeg"
+        if path.exists():
+            return FileResponse(
+                path,
+                media_type="image/jpeg",
+                headers={"Cache-Control": "public, max-age=86400"},
+            )
+    raise HTTPException(status_code=404, detail="Thumbnail not found")
+
+
 @app.post("/register", response_model=schemas.User)
 def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_username(db, username=user.username)
@@ -114,18 +246,17 @@ def login(user: schemas.UserCreate, db: Session = Depends(get_db)):
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = auth.create_access_token(data={"sub": user.username})
+    access_token = auth.create_access_token(data=auth.token_claims(db_user))
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.post("/change-password")
 def change_password(
     new_password: str,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
     db: Session = Depends(get_db),
 ):
-    current_user.hashed_password = auth.get_password_hash(new_password)
-    db.commit()
+    crud.change_password(db, current_user.id, new_password)
     return {"message": "Password changed successfully"}
 
 
@@ -138,59 +269,115 @@ def get_image(image_id: int, db: Session = Depends(get_db)):
 
 
 @app.post("/upload-audio/{image_id}", response_model=schemas.Audio)
-def upload_audio(
+async def upload_audio(
     image_id: int,
-    audio: UploadFile = File(...),
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
 ):
-    image = crud.get_image(db, image_id=image_id)
-    if not image:
+    # The multipart body is streamed by receive_audio, the file is expected in
+    # the "audio" field
+    if not await asyncio.to_thread(image_exists, db, image_id):
         raise HTTPException(status_code=404, detail="Image not found")
 
+    upload = await receive_audio(request)
+    content_hash = upload.sha256.hexdigest()
+    existing = await asyncio.to_thread(
+        crud.get_audio_by_hash, db, current_user.id, image_id, content_hash
+    )
+    if existing is not None and (UPLOADS_FOLDER / existing.filename).exists():
+        upload.discard()
+        return existing
+
+    # Only the extension of the client's filename is kept, and only if it is
+    # plain ASCII, so the stored name is safe in paths, URLs and headers
     current_time = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    audio_filename = (
-        f"audio_{image_id}_{current_user.id}_{current_time}_{audio.filename}"
+    extension = Path(upload.filename or "").suffix.lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,8}", extension):
+        extension = ""
+    stored_name = content_hash + extension
+    audio_filename = f"audio_{image_id}_{current_user.id}_{current_time}_{stored_name}"
+    audio_create = schemas.AudioCreate(
+        filename=audio_filename, image_id=image_id, content_hash=content_hash
     )
 
-    with open(f"uploads/{audio_filename}", "wb") as buffer:
-        shutil.copyfileobj(audio.file, buffer)
+    def store_audio():
+        with uploads_lock(shared=True):
+            os.replace(upload.path, UPLOADS_FOLDER / audio_filename)
+            return crud.create_audio(db=db, audio=audio_create, user_id=current_user.id)
 
-    audio_create = schemas.AudioCreate(filename=audio_filename, image_id=image_id)
-    return crud.create_audio(db=db, audio=audio_create, user_id=current_user.id)
+    return await asyncio.to_thread(store_audio)
 
 
 @app.get("/audio/{audio_id}")
-def get_audio_file(audio_id: int, db: Session = Depends(get_db)):
-    audio = crud.get_audio(db, audio_id=audio_id)
-    if not audio:
-        raise HTTPException(status_code=404, detail="Audio not found")
+def get_audio_file(audio_id: int, request: Request, db: Session = Depends(get_db)):
+    return audio_file_response(request, db, audio_id)
 
-    file_path = f"uploads/{audio.filename}"
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Audio file not found")
 
-    return FileResponse(file_path, media_type="audio/ogg", filename=audio.filename)
+def audio_page(response: Response, page_function, **kwargs):
+    # The body stays a plain list, the cursor of the next page is sent in the
+    # X-Next-Cursor header and passed back as ?cursor=
+    try:
+        audios, next_cursor = page_function(**kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return audios
 
 
 @app.get("/image/{image_id}/audios", response_model=list[schemas.Audio])
 def get_audios_for_image(
     image_id: int,
+    response: Response,
     db: Session = Depends(get_db),
-    skip: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
     limit: int = Query(10, ge=1, le=100),
 ):
-    return crud.get_audios_for_image(db, image_id=image_id, skip=skip, limit=limit)
+    return audio_page(
+        response,
+        crud.get_audios_for_image,
+        db=db,
+        image_id=image_id,
+        cursor=cursor,
+        limit=limit,
+    )
 
 
 @app.get("/user/audios", response_model=list[schemas.Audio])
 def get_user_audios(
+    response: Response,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=100),
 ):
-    return crud.get_audios_for_user(db, user_id=current_user.id)
+    return audio_page(
+        response,
+        crud.get_audios_for_user,
+        db=db,
+        user_id=current_user.id,
+        cursor=cursor,
+        limit=limit,
+    )
 
 
 @app.get("/artwork-embeddings", response_model=list[schemas.ArtworkEmbedding])
-def get_artwork_embeddings():
-    return crud.get_all_artwork_embeddings()
+def get_artwork_embeddings(request: Request, format: str = "json"):
+    # format=json keeps the list of {id, embedding}. base64 and float16 return
+    # {ids, dtype, shape, data} with little-endian data, binary returns the raw
+    # float32 matrix whose rows follow the ids of format=ids.
+    return embeddings_response(request, format)
+
+
+@app.get(
+    "/artwork-embeddings/{artwork_id}/similar",
+    response_model=list[schemas.SimilarEmbedding],
+)
+def get_similar_artworks(artwork_id: str, k: int = Query(10, ge=1, le=100)):
+    return similar_artworks(artwork_id, k)
+
+
+@app.post("/artwork-embeddings/similar", response_model=list[schemas.SimilarEmbedding])
+def find_similar_embeddings(query: schemas.EmbeddingQuery):
+    return similar_to_embedding(query.embedding, query.k)
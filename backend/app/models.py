@@ -1,5 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, func
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Boolean,
+    DateTime,
+    Index,
+)
 from sqlalchemy.orm import relationship
+from datetime import datetime
 from .database import Base
 
 
@@ -34,7 +43,18 @@ class Audio(Base):
     filename = Column(String, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     image_id = Column(Integer, ForeignKey("images.id"))
-    created_at = Column(DateTime, default=func.now())
+    # Set here and not by the database: SQLite's CURRENT_TIMESTAMP is text in
+    # whole seconds, which does not compare with the microsecond timestamps
+    # of the pagination cursors
+    created_at = Column(DateTime, default=datetime.now)
+    # sha256 of the file, identical re-uploads reuse the existing row
+    content_hash = Column(String(64), index=True)
 
     user = relationship("User", back_populates="audios")
     image = relationship("Image", back_populates="audios")
+
+    # Back the keyset pagination of the per-image and per-user audio feeds
+    __table_args__ = (
+        Index("ix_audios_image_created_id", "image_id", "created_at", "id"),
+        Index("ix_audios_user_created_id", "user_id", "created_at", "id"),
+    )
@@ -0,0 +1,219 @@
+import os
+from pathlib import Path
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+search_params = dict(checks=50)
+flann = cv2.FlannBasedMatcher(index_params, search_params)
+
+RATIO_TEST = 0.7
+# Neighbours fetched per query descriptor. The ratio test is done per painting,
+# so we need enough neighbours to usually see a painting's best and second best
+# descriptor in the same result row.
+NEIGHBOURS = 8
+# The global votes only shortlist paintings; the best RERANK_CANDIDATES are
+# then scored exactly like a per-painting knnMatch would, so similarity stays
+# comparable. The votes can rank a painting lower than that scan would, and it
+# is then missed: vote_recall of benchmarks/recognition.py shows how deep the
+# shortlist has to be. Every candidate costs one knnMatch.
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 5))
+
+# Geometric verification: a homography is fitted with RANSAC to the ratio-test
+# matches of the best candidates and they are ranked by inlier count instead.
+RANSAC_REPROJECTION_ERROR = 5.0
+# Below this many inliers a photo is not considered to show any painting
+VERIFY_MIN_INLIERS = int(os.getenv("VERIFY_MIN_INLIERS", 20))
+# Verification stops early once a candidate has this many inliers and beats
+# the runner-up and the votes of the candidates left by VERIFY_MARGIN
+VERIFY_CONFIDENT_INLIERS = int(os.getenv("VERIFY_CONFIDENT_INLIERS", 30))
+VERIFY_MARGIN = float(os.getenv("VERIFY_MARGIN", 2.0))
+
+
+class PaintingIndex:
+    # All painting descriptors stacked into one FLANN index, built once. Row i
+    # of the index belongs to painting row_painting[i].
+
+    def __init__(
+        self, painting_files, descriptors, offsets, keypoints=None, index_file=None
+    ):
+        self.painting_files = list(painting_files)
+        self.descriptors = descriptors
+        self.keypoints = keypoints
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.keypoint_counts = np.diff(self.offsets)
+        self.row_painting = np.repeat(
+            np.arange(len(self.painting_files), dtype=np.int64), self.keypoint_counts
+        )
+        # Built on first use, the prefilter path never needs the KD-tree
+        self.flann = None
+        self.index_file = index_file
+
+    @classmethod
+    def from_store(cls, store):
+        painting_files = [Path(name) for name in store.painting_names]
+        return cls(
+            painting_files,
+            store.descriptors,
+            store.offsets,
+            store.keypoints,
+            index_file=store.path / f"kdtree-{store.generation}.flann",
+        )
+
+    def __len__(self):
+        return len(self.painting_files)
+
+    def votes(self, query_des):
+        # Number of ratio-test matches per painting for one query image.
+        return self.batch_votes([query_des])[0]
+
+    def batch_votes(self, query_descriptors):
+        # Votes for several query images, searched in a single knnSearch over
+        # their stacked descriptors. Row i of the result belongs to query i.
+        votes = np.zeros((len(query_descriptors), len(self)), dtype=np.int64)
+        lengths = [0 if des is None else len(des) for des in query_descriptors]
+        if len(self.descriptors) == 0 or sum(lengths) == 0:
+            return votes
+        if self.flann is None:
+            self.flann = self.load_or_build_flann()
+
+        query_des = np.vstack(
+            [
+                np.asarray(des, dtype=np.float32)
+                for des in query_descriptors
+                if des is not None and len(des)
+            ]
+        )
+        k = min(NEIGHBOURS, len(self.descriptors))
+        rows, distances = self.flann.knnSearch(query_des, k, params=search_params)
+        rows = rows.reshape(len(query_des), k)
+        # FLANN reports squared L2 distances
+        distances = distances.reshape(len(query_des), k)
+
+        # Group the neighbours by (query descriptor, painting). The sort is
+        # stable, so inside a group they stay ordered by distance.
+        paintings = self.row_painting[rows]
+        keys = (np.arange(len(query_des))[:, None] * len(self) + paintings).ravel()
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        flat_distances = distances.ravel()[order]
+        query_rows = order // k
+
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        has_second = np.zeros(len(keys), dtype=bool)
+        has_second[:-1] = first[:-1] & ~first[1:]
+
+        best = flat_distances[first]
+        if k < len(self.descriptors):
+            # The second best descriptor of this painting is at least as far
+            # away as the last neighbour we fetched.
+            second = distances[query_rows[first], -1]
+        else:
+            second = np.full(len(best), np.inf, dtype=np.float32)
+        second_positions = np.flatnonzero(has_second)
+        second[has_second[first]] = flat_distances[second_positions + 1]
+
+        good = best < (RATIO_TEST**2) * second
+        matched = keys[first][good]
+        query_images = np.repeat(np.arange(len(query_descriptors)), lengths)
+        matched = query_images[matched // len(self)] * len(self) + matched % len(self)
+        votes += np.bincount(matched, minlength=votes.size).reshape(votes.shape)
+        return votes
+
+    def load_or_build_flann(self):
+        # The KD-tree is saved next to the store, so only the first worker of
+        # the first server process pays for building it. Loaded or built, the
+        # index keeps its own copy of the descriptors in this process.
+        flann_index = cv2.flann_Index()
+        if self.index_file is not None and flann_index.load(
+            self.descriptors, str(self.index_file)
+        ):
+            return flann_index
+
+        flann_index = cv2.flann_Index(self.descriptors, index_params)
+        if self.index_file is not None:
+            temporary = self.index_file.with_suffix(f".tmp-{os.getpid()}")
+            try:
+                flann_index.save(str(temporary))
+                os.replace(temporary, self.index_file)
+                for stale in self.index_file.parent.glob("kdtree-*.flann"):
+                    if stale != self.index_file:
+                        stale.unlink(missing_ok=True)
+            except (OSError, cv2.error) as e:
+                print(f"Could not save the KD-tree: {e}")
+        return flann_index
+
+    def painting_matches(self, query_des, painting):
+        # Same ratio test as matching against this painting alone, the second
+        # best neighbour comes from the same painting.
+        start, end = self.offsets[painting], self.offsets[painting + 1]
+        matches = flann.knnMatch(query_des, self.descriptors[start:end], k=2)
+        return [
+            m
+            for m, n in (pair for pair in matches if len(pair) == 2)
+            if m.distance < RATIO_TEST * n.distance
+        ]
+
+    def painting_score(self, query_des, query_kp_count, painting):
+        good_matches = self.painting_matches(query_des, painting)
+        return len(good_matches) / max(query_kp_count, self.keypoint_counts[painting])
+
+    def inlier_count(self, query_points, matches, painting):
+        if len(matches) < 4:
+            return 0
+        query_rows = [m.queryIdx for m in matches]
+        painting_rows = [self.offsets[painting] + m.trainIdx for m in matches]
+        _, mask = cv2.findHomography(
+            query_points[query_rows],
+            self.keypoints[painting_rows, :2],
+            cv2.RANSAC,
+            RANSAC_REPROJECTION_ERROR,
+        )
+        return 0 if mask is None else int(mask.sum())
+
+    def verified_match(
+        self, query_des, query_points, query_kp_count, candidates, match_bounds=None
+    ):
+        # Visits the candidates in shortlist order, best first, matching each
+        # one only when it is reached. Verification stops once the best has
+        # VERIFY_CONFIDENT_INLIERS and beats by VERIFY_MARGIN the runner-up and
+        # the estimate for the candidates not yet visited: their shortlist
+        # votes (match_bounds) if given. The votes come from the global search
+        # and can undercount a painting's own ratio-test matches, so this is a
+        # heuristic, not a bound. Returns the position of the best candidate,
+        # its inlier based score and the inlier count.
+        query_des = np.ascontiguousarray(query_des, dtype=np.float32)
+        best, best_inliers, runner_up = 0, -1, 0
+        for position, painting in enumerate(candidates):
+            matches = self.painting_matches(query_des, painting)
+            inliers = self.inlier_count(query_points, matches, painting)
+            if inliers > best_inliers:
+                runner_up = max(runner_up, best_inliers)
+                best, best_inliers = position, inliers
+            else:
+                runner_up = max(runner_up, inliers)
+
+            remaining = 0
+            if match_bounds is not None and position + 1 < len(candidates):
+                remaining = max(match_bounds[position + 1 :])
+            if best_inliers >= VERIFY_CONFIDENT_INLIERS and best_inliers >= (
+                VERIFY_MARGIN * max(runner_up, remaining)
+            ):
+                break
+
+        painting = candidates[best]
+        score = best_inliers / max(query_kp_count, self.keypoint_counts[painting])
+        return best, float(score), best_inliers
+
+    def best_match_among(self, query_des, query_kp_count, candidates):
+        # Exact per-painting scores for the given candidates, returns the
+        # position of the best candidate and its score.
+        query_des = np.ascontiguousarray(query_des, dtype=np.float32)
+        scores = [
+            self.painting_score(query_des, query_kp_count, painting)
+            for painting in candidates
+        ]
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import fcntl
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from pathlib import Path
+from fastapi import HTTPException
+import numpy as np
+from . import preprocessing
+from .feature_store import FeatureStore
+from .global_descriptor import EmbeddingIndex
+from .painting_index import PaintingIndex, RERANK_CANDIDATES, VERIFY_MIN_INLIERS
+
+# SIFT extraction and matching run in worker processes, so they neither block
+# the event loop nor compete for the GIL with the request handlers. Every
+# worker holds its own copy of the store descriptors and the KD-tree (see
+# painting_index.py), so the default is kept small.
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", 2))
+# Requests queued or running at once, anything above is rejected with a 503
+RECOGNITION_MAX_PENDING = int(
+    os.getenv("RECOGNITION_MAX_PENDING", RECOGNITION_WORKERS * 4)
+)
+RECOGNITION_RETRY_AFTER = int(os.getenv("RECOGNITION_RETRY_AFTER", 2))
+# Candidates picked by the global descriptor before SIFT matching, 0 matches
+# every painting through the descriptor index instead. The global descriptor
+# only ranks roughly: on the 356 crawled paintings the painting the full scan
+# finds for the test photos ranked 3rd to 20th, for test_images/unused/test2.jpeg
+# 45th, so K should be 50 or more.
+# prefilter_recall of benchmarks/recognition.py measures it for a gallery.
+PREFILTER_TOP_K = int(os.getenv("PREFILTER_TOP_K", 0))
+# Rank the candidates by RANSAC homography inliers and reject photos without
+# enough of them
+GEOMETRIC_VERIFICATION = os.getenv("GEOMETRIC_VERIFICATION", "0") == "1"
+# Unix socket of the recognition service shared by all server processes on the
+# host (python -m app.recognition_pool), started by the first server process
+# that needs it. The service unpickles what it receives, so it only runs with
+# RECOGNITION_SERVICE_KEY set. Without a key, or with RECOGNITION_SERVICE set
+# to "", every server process starts its own pool, and the memory of the
+# workers multiplies with the processes.
+RECOGNITION_SERVICE = os.getenv("RECOGNITION_SERVICE", "recognition.sock")
+RECOGNITION_SERVICE_KEY = os.getenv("RECOGNITION_SERVICE_KEY", "").encode()
+SERVICE_START_TIMEOUT = int(os.getenv("SERVICE_START_TIMEOUT", 10))
+
+executor = None
+executor_lock = threading.Lock()
+pending = 0
+pending_lock = threading.Lock()
+
+# State of a worker process: a read-only view of the feature store and the
+# index built on top of it, replaced when the store generation changes.
+worker_index = None
+worker_embeddings = None
+worker_generation = None
+
+
+def use_service():
+    return bool(RECOGNITION_SERVICE and RECOGNITION_SERVICE_KEY)
+
+
+def get_executor():
+    global executor
+
+    with executor_lock:
+        if executor is None:
+            if RECOGNITION_SERVICE and not RECOGNITION_SERVICE_KEY:
+                print(
+                    "RECOGNITION_SERVICE_KEY is not set, recognition runs in a pool "
+                    "of this process"
+                )
+            executor = ProcessPoolExecutor(
+                max_workers=RECOGNITION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return executor
+
+
+def shutdown(broken=None, wait=False):
+    # With broken given, only that pool is shut down; requests that saw the
+    # same crash must not take down the pool that replaced it.
+    global executor
+
+    with executor_lock:
+        if executor is not None and broken in (None, executor):
+            executor.shutdown(wait=wait, cancel_futures=True)
+            executor = None
+
+
+def attach_index(store_dir, generation):
+    global worker_index, worker_embeddings, worker_generation
+
+    if worker_index is None or worker_generation != generation:
+        store = FeatureStore.open(Path(store_dir), verify=False)
+        worker_index = PaintingIndex.from_store(store)
+        worker_embeddings = None
+        if PREFILTER_TOP_K > 0:
+            worker_embeddings = EmbeddingIndex.load(store.path, store.generation)
+            if worker_embeddings is None:
+                worker_embeddings = EmbeddingIndex.build(store)
+        worker_generation = store.generation
+    return worker_index
+
+
+def recognize(image_bytes, store_dir, generation):
+    features = extract(image_bytes)
+    if features is None:
+        return None
+    painting_index = attach_index(store_dir, generation)
+    return match_features(painting_index, worker_embeddings, *features)
+
+
+def extract(image_bytes):
+    # Returns the keypoint positions, descriptors and shape of the query image
+    query_image = preprocessing.decode(image_bytes)
+    if query_image is None:
+        return None
+    query_kp, query_des = preprocessing.extract_features(query_image)
+    query_points = np.array([kp.pt for kp in query_kp], dtype=np.float32)
+    return query_points.reshape(-1, 2), query_des, query_image.shape
+
+
+def extract_batch(images):
+    return [extract(image_bytes) for image_bytes in images]
+
+
+def match_batch(features, store_dir, generation):
+    # Matches the features of several query images, the shortlist votes of all
+    # of them come from one search over the painting index.
+    painting_index = attach_index(store_dir, generation)
+    votes = [None] * len(features)
+    if worker_embeddings is None:
+        votes = painting_index.batch_votes(
+            [None if f is None else f[1] for f in features]
+        )
+    return [
+        (
+            None
+            if f is None
+            else match_features(painting_index, worker_embeddings, *f, votes=v)
+        )
+        for f, v in zip(features, votes)
+    ]
+
+
+def match_features(
+    painting_index, embeddings, query_points, query_des, image_shape, votes=None
+):
+    result = {
+        "keypoints": len(query_points),
+        "similar_artwork_id": None,
+        "similarity": 0.0,
+    }
+    if query_des is None or len(query_des) == 0:
+        return result
+
+    # Stage one: shortlist candidates, ordered best first
+    if embeddings is not None:
+        query_embedding = embeddings.embed_query(query_points, query_des, image_shape)
+        candidates, embedding_scores = embeddings.top_k(
+            query_embedding, PREFILTER_TOP_K
+        )
+        match_bounds = None
+    else:
+        if votes is None:
+            votes = painting_index.votes(query_des)
+        candidates = np.argsort(-votes, kind="stable")[:RERANK_CANDIDATES]
+        candidates = candidates[votes[candidates] > 0]
+        match_bounds = votes[candidates]
+    if len(candidates) == 0:
+        return result
+
+    # Stage two: SIFT ratio test, optionally verified with a homography
+    if GEOMETRIC_VERIFICATION:
+        best, best_score, inliers = painting_index.verified_match(
+            query_des, query_points, len(query_points), candidates, match_bounds
+        )
+        result["inliers"] = inliers
+        if inliers < VERIFY_MIN_INLIERS:
+            return result
+    else:
+        best, best_score = painting_index.best_match_among(
+            query_des, len(query_points), candidates
+        )
+
+    result["similar_artwork_id"] = painting_index.painting_files[candidates[best]].stem
+    result["similarity"] = best_score
+    if embeddings is not None:
+        result["embedding_similarity"] = float(embedding_scores[best])
+    return result
+
+
+SERVICE_FUNCTIONS = {
+    function.__name__: function for function in (recognize, extract_batch, match_batch)
+}
+
+
+def unavailable(detail):
+    return HTTPException(
+        status_code=503,
+        detail=detail,
+        headers={"Retry-After": str(RECOGNITION_RETRY_AFTER)},
+    )
+
+
+def connect():
+    return Client(
+        RECOGNITION_SERVICE, family="AF_UNIX", authkey=RECOGNITION_SERVICE_KEY
+    )
+
+
+def start_service():
+    # Any server process that finds no service starts one; of several started
+    # at once all but one exit on the service lock. The service stops with the
+    # process that started it and the next request starts another.
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.recognition_pool", "--parent", str(os.getpid())]
+    )
+    threading.Thread(target=process.wait, daemon=True).start()
+
+
+def connect_or_start():
+    try:
+        return connect()
+    except (FileNotFoundError, ConnectionRefusedError):
+        start_service()
+    deadline = time.monotonic() + SERVICE_START_TIMEOUT
+    while True:
+        try:
+            return connect()
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def call_service(name, args):
+    with connect_or_start() as connection:
+        connection.send((name, args))
+        return connection.recv()
+
+
+async def run(function, *args):
+    global pending
+
+    if pending >= RECOGNITION_MAX_PENDING:
+        raise unavailable("Recognition is overloaded, try again later")
+
+    pending += 1
+    try:
+        if use_service():
+            try:
+                status, value = await asyncio.to_thread(
+                    call_service, function.__name__, args
+                )
+            except (OSError, EOFError, AuthenticationError) as e:
+                print(f"Recognition service unreachable: {e!r}")
+                raise unavailable("Recognition service unavailable, try again")
+            if status == "error":
+                raise RuntimeError(f"Recognition failed: {value}")
+            if status != "ok":
+                raise unavailable(value)
+            return value
+
+        pool = get_executor()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(pool, function, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM), start a fresh pool for the next request
+            shutdown(pool)
+            raise unavailable("Recognition worker crashed, try again")
+    finally:
+        pending -= 1
+
+
+def handle(connection):
+    # One request of a server process, on its own thread of the service
+    global pending
+
+    with connection:
+        try:
+            name, args = connection.recv()
+        except (OSError, EOFError):
+            return
+        with pending_lock:
+            overloaded = pending >= RECOGNITION_MAX_PENDING
+            if not overloaded:
+                pending += 1
+        if overloaded:
+            reply = ("unavailable", "Recognition is overloaded, try again later")
+        else:
+            pool = get_executor()
+            try:
+                reply = ("ok", pool.submit(SERVICE_FUNCTIONS[name], *args).result())
+            except BrokenProcessPool:
+                shutdown(pool)
+                reply = ("unavailable", "Recognition worker crashed, try again")
+            except Exception as e:
+                reply = ("error", repr(e))
+            finally:
+                with pending_lock:
+                    pending -= 1
+        try:
+            connection.send(reply)
+        except OSError:
+            pass
+
+
+def watch_parent(parent, address):
+    while os.getppid() == parent:
+        time.sleep(1)
+    print("Server process gone, stopping the recognition service")
+    shutdown(wait=True)
+    if os.path.exists(address):
+        os.remove(address)
+    os._exit(0)
+
+
+def serve(address, parent=None):
+    # Recognition service: one pool of RECOGNITION_WORKERS for all server
+    # processes of the host, which connect with RECOGNITION_SERVICE=address.
+    if not RECOGNITION_SERVICE_KEY:
+        raise SystemExit("RECOGNITION_SERVICE_KEY has to be set")
+    lock = open(address + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"Recognition service on {address} is already running")
+        return
+    if os.path.exists(address):
+        os.remove(address)
+    # The socket is only accessible to its owner from the moment it is bound
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family="AF_UNIX", authkey=RECOGNITION_SERVICE_KEY)
+    finally:
+        os.umask(umask)
+    if parent is not None:
+        threading.Thread(
+            target=watch_parent, args=(parent, address), daemon=True
+        ).start()
+    with listener:
+        print(f"Recognition service on {address}, {RECOGNITION_WORKERS} workers")
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, AuthenticationError) as e:
+                    print(f"Rejected a recognition connection: {e!r}")
+                    continue
+                threading.Thread(target=handle, args=(connection,), daemon=True).start()
+        finally:
+            shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recognition service shared by the server processes of the host"
+    )
+    parser.add_argument(
+        "--parent", type=int, help="stop when the process with this pid exits"
+    )
+    args = parser.parse_args()
+    serve(RECOGNITION_SERVICE or "recognition.sock", args.parent)
@@ -0,0 +1,84 @@
+import os
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+# Visitors in front of the same painting send near identical photos. Results
+# are cached under a perceptual hash of the photo, so a retake is answered
+# without running SIFT.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))  # 0 disables
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+# Hashes that differ in at most this many of their 64 bits count as the same photo
+RESULT_CACHE_RADIUS = int(os.getenv("RESULT_CACHE_RADIUS", 6))
+
+
+def perceptual_hash(image_bytes):
+    # pHash: sign of the low frequency DCT coefficients of a 32x32 thumbnail,
+    # compared to their median. The 8x8 block starts at (1, 1), so it leaves
+    # out the DC term and gives 64 bits. Decoding at 1/8 size keeps this cheap.
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    image = cv2.imdecode(nparr, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+    thumbnail = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(np.float32(thumbnail))[1:9, 1:9].ravel()
+    bits = low_frequencies > np.median(low_frequencies)
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+class ResultCache:
+    def __init__(self, size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # hash -> (expiry, result)
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self, generation=None):
+        self.entries.clear()
+        self.generation = generation
+
+    def get(self, image_hash, generation, radius=RESULT_CACHE_RADIUS):
+        if self.size <= 0:
+            return None
+        if generation != self.generation:
+            # The feature index was rebuilt, cached results may be stale
+            self.clear(generation)
+        now = time.monotonic()
+        for cached_hash, (expiry, result) in list(self.entries.items()):
+            if expiry < now:
+                del self.entries[cached_hash]
+                self.evictions += 1
+            elif bin(cached_hash ^ image_hash).count("1") <= radius:
+                self.entries.move_to_end(cached_hash)
+                self.hits += 1
+                return dict(result)
+        self.misses += 1
+        return None
+
+    def put(self, image_hash, generation, result):
+        if self.size <= 0:
+            return
+        if generation != self.generation:
+            self.clear(generation)
+        self.entries[image_hash] = (time.monotonic() + self.ttl, dict(result))
+        self.entries.move_to_end(image_hash)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+result_cache = ResultCache()
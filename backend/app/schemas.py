@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import Optional
 
@@ -17,9 +17,43 @@ class ArtworkEmbedding(BaseModel):
         from_attributes = True
 
 
+class SimilarEmbedding(BaseModel):
+    id: str
+    similarity: float
+
+
+class EmbeddingQuery(BaseModel):
+    embedding: list[float]
+    k: int = Field(10, ge=1, le=100)
+
+
 class SimilarArtworkResponse(BaseModel):
     similar_artwork_id: Optional[str]
     similarity: float
+    # Cosine similarity of the prefilter stage, when it is enabled
+    embedding_similarity: Optional[float] = None
+    # RANSAC inliers of the match, when geometric verification is enabled
+    inliers: Optional[int] = None
+
+
+class BatchArtworkResult(SimilarArtworkResponse):
+    filename: Optional[str] = None
+    # Set when this image could not be processed
+    error: Optional[str] = None
+
+
+class FeatureRefresh(BaseModel):
+    added: int
+    changed: int
+    removed: int
+    unchanged: int
+
+
+class AudioReconcile(BaseModel):
+    added: int
+    removed: int
+    unchanged: int
+    skipped: int
 
 
 class User(BaseModel):
@@ -46,9 +80,16 @@ class Image(ImageCreate):
         from_attributes = True
 
 
+class ImageBulkResult(BaseModel):
+    created: int
+    updated: int
+    unchanged: int
+
+
 class AudioCreate(BaseModel):
     filename: str
     image_id: int
+    content_hash: Optional[str] = None
 
 
 class Audio(AudioCreate):
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from fastapi import HTTPException
+
+# Slow startup work (feature index, audio reconciliation) runs as background
+# tasks once the server accepts connections. /readyz reports their state so
+# the load balancer only routes traffic once the required ones are warm.
+WARMING_RETRY_AFTER = 5
+
+
+class Subsystem:
+    def __init__(self, name, required=True):
+        self.name = name
+        # Subsystems that are not required are reported but never hold back
+        # readiness
+        self.required = required
+        self.state = "pending"  # pending, running, ready or failed
+        self.done = 0
+        self.total = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def progress(self, done, total):
+        self.done, self.total = done, total
+
+    def as_dict(self):
+        result = {"state": self.state}
+        if self.total:
+            result["progress"] = {"done": self.done, "total": self.total}
+        if self.started is not None:
+            result["seconds"] = round(
+                (self.finished or time.monotonic()) - self.started, 1
+            )
+        if self.error:
+            result["error"] = self.error
+        if not self.required:
+            result["required"] = False
+        return result
+
+
+subsystems = {}
+tasks = []
+
+
+def subsystem(name, required=True):
+    if name not in subsystems:
+        subsystems[name] = Subsystem(name, required)
+    return subsystems[name]
+
+
+def start(name, function, required=True):
+    # Runs function in a thread, it can report progress through
+    # subsystem(name).progress
+    current = subsystem(name, required)
+
+    async def run():
+        current.state = "running"
+        current.started = time.monotonic()
+        try:
+            await asyncio.to_thread(function)
+        except Exception as e:
+            current.state = "failed"
+            current.error = str(e)
+            print(f"Warm-up of {name} failed: {e}")
+        else:
+            current.state = "ready"
+            print(f"Warm-up of {name} done")
+        finally:
+            current.finished = time.monotonic()
+
+    tasks.append(asyncio.create_task(run()))
+
+
+def is_ready():
+    return all(
+        current.state == "ready" for current in subsystems.values() if current.required
+    )
+
+
+def mark_ready(name):
+    # The work was done outside the warm-up, e.g. retried lazily after the
+    # warm-up failed
+    current = subsystems.get(name)
+    if current is not None and current.state != "ready":
+        current.state = "ready"
+        current.error = None
+        current.finished = time.monotonic()
+
+
+def require(name):
+    # A failed warm-up does not block requests, they retry the work lazily
+    current = subsystems.get(name)
+    if current is not None and current.state in ("pending", "running"):
+        raise HTTPException(
+            status_code=503,
+            detail=f"Warming up {name}, try again later",
+            headers={"Retry-After": str(WARMING_RETRY_AFTER)},
+        )
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Login burst benchmark, run from the backend folder:
+#   python -m benchmarks.logins --clients 32 --logins 10 --output logins.json
+# A temporary SQLite database is used unless DATABASE_URL is set. Hashing
+# settings (BCRYPT_ROUNDS, HASHING_WORKERS, HASHING_MAX_PENDING) come from the
+# environment. While the burst runs, a probe measures how a cheap endpoint
+# (GET /healthz) is affected.
+PASSWORD = "benchmark!password"
+
+
+def run(args):
+    from fastapi.testclient import TestClient
+    from app import auth, crud, schemas
+    from app.database import SessionLocal
+    from app.main import app
+    from benchmarks.recognition import git_commit, percentiles
+
+    db = SessionLocal()
+    for i in range(args.clients):
+        username = f"benchmark{i}"
+        if crud.get_user_by_username(db, username) is None:
+            crud.create_user(
+                db, schemas.UserCreate(username=username, password=PASSWORD)
+            )
+    db.close()
+
+    # No context manager, the startup warm-up is not needed here
+    client = TestClient(app)
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def login(i):
+        for _ in range(args.logins):
+            start = time.perf_counter()
+            response = client.post(
+                "/token", json={"username": f"benchmark{i}", "password": PASSWORD}
+            )
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[response.status_code] = (
+                    statuses.get(response.status_code, 0) + 1
+                )
+
+    probe_latencies = []
+    done = threading.Event()
+
+    def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get("/healthz")
+            probe_latencies.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.01)
+
+    probe_thread = threading.Thread(target=probe)
+    probe_thread.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(login, range(args.clients)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    probe_thread.join()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "clients": args.clients,
+            "logins_per_client": args.logins,
+            "hashing": auth.hashing_stats(),
+        },
+        "login_latency_ms": percentiles(latencies),
+        "logins_per_s": round(statuses.get(200, 0) / elapsed, 2),
+        "statuses": {str(code): count for code, count in statuses.items()},
+        "probe_latency_ms": percentiles(probe_latencies),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a burst of logins")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument(
+        "--logins", type=int, default=5, help="Logins per client, one after another"
+    )
+    parser.add_argument("--output", type=Path, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{workdir}/benchmark.db")
+        report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    print(text)
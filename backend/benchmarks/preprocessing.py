@@ -0,0 +1,138 @@
+import argparse
+import json
+import re
+import time
+from pathlib import Path
+import numpy as np
+from app import preprocessing
+from app.feature_store import keypoints_to_array
+from app.painting_index import PaintingIndex
+from app.recognition_pool import match_features
+
+# Run from the backend folder:
+#   python -m benchmarks.preprocessing --limit 100
+# Every setting re-extracts the gallery, since both sides have to use the
+# same preprocessing to be comparable.
+DEFAULT_SETTINGS = [
+    {},
+    {"max_image_edge": 1600},
+    {"max_image_edge": 1024, "max_keypoints": 2000},
+    {"decode_reduction": 2, "max_keypoints": 2000},
+    {"max_image_edge": 800, "max_keypoints": 1000, "normalize_contrast": True},
+]
+
+
+def parse_setting(text):
+    setting = {}
+    for item in text.split(","):
+        key, value = item.split("=")
+        setting[key] = (
+            value.lower() in ("1", "true")
+            if key == "normalize_contrast"
+            else int(value)
+        )
+    return setting
+
+
+def expected_artwork(query_file):
+    # Test photos are named like photo_2024-09-14_17-54-14(7488).jpg
+    match = re.search(r"\((\d+)\)", query_file.name)
+    return match.group(1) if match else None
+
+
+def gallery_files(gallery, queries, limit):
+    files = sorted(gallery.glob("*.jpeg"))
+    if limit:
+        expected = {expected_artwork(query) for query in queries}
+        files = [f for f in files if f.stem in expected] + [
+            f for f in files if f.stem not in expected
+        ][: max(0, limit - len(expected))]
+    return files
+
+
+def build_index(files, settings):
+    names, keypoints, descriptors, offsets = [], [], [], [0]
+    for painting_file in files:
+        image = preprocessing.load(painting_file, settings)
+        if image is None:
+            continue
+        kp, des = preprocessing.extract_features(image, settings)
+        if des is None:
+            continue
+        names.append(Path(painting_file.name))
+        keypoints.append(keypoints_to_array(kp))
+        descriptors.append(des)
+        offsets.append(offsets[-1] + len(des))
+    return PaintingIndex(names, np.vstack(descriptors), offsets, np.vstack(keypoints))
+
+
+def run_setting(setting, files, queries):
+    settings = preprocessing.PreprocessingSettings(**setting)
+    start = time.perf_counter()
+    painting_index = build_index(files, settings)
+    gallery_seconds = time.perf_counter() - start
+
+    latencies, keypoint_counts, correct = [], [], 0
+    for query_file in queries:
+        image_bytes = query_file.read_bytes()
+        start = time.perf_counter()
+        image = preprocessing.decode(image_bytes, settings)
+        query_kp, query_des = preprocessing.extract_features(image, settings)
+        query_points = np.array([kp.pt for kp in query_kp], dtype=np.float32)
+        result = match_features(
+            painting_index, None, query_points.reshape(-1, 2), query_des, image.shape
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        keypoint_counts.append(len(query_kp))
+        correct += result["similar_artwork_id"] == expected_artwork(query_file)
+
+    return {
+        "settings": settings.as_dict(),
+        "gallery_paintings": len(painting_index),
+        "gallery_extraction_s": round(gallery_seconds, 3),
+        "query_latency_ms": {
+            "mean": round(float(np.mean(latencies)), 1),
+            "p50": round(float(np.percentile(latencies, 50)), 1),
+            "max": round(float(np.max(latencies)), 1),
+        },
+        "query_keypoints_mean": round(float(np.mean(keypoint_counts)), 1),
+        "top1_accuracy": correct / len(queries),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare query preprocessing settings on latency and accuracy"
+    )
+    parser.add_argument(
+        "--gallery", type=Path, default=Path("../crawler/belvedere_images")
+    )
+    parser.add_argument("--queries", type=Path, default=Path("test_images"))
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=0,
+        help="Gallery size, the paintings shown in the test photos are always included",
+    )
+    parser.add_argument(
+        "--setting",
+        action="append",
+        type=parse_setting,
+        help="Comma separated settings, e.g. max_image_edge=1024,max_keypoints=2000",
+    )
+    parser.add_argument("--output", type=Path, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    queries = sorted(args.queries.glob("*.jpg"))
+    files = gallery_files(args.gallery, queries, args.limit)
+    report = {
+        "queries": len(queries),
+        "results": [
+            run_setting(setting, files, queries)
+            for setting in args.setting or DEFAULT_SETTINGS
+        ],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    print(text)
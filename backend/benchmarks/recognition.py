@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+import cv2
+import numpy as np
+from fastapi import HTTPException
+from app import preprocessing, recognition_pool
+from app.feature_store import FeatureStore, FeatureStoreWriter, keypoints_to_array
+from app.global_descriptor import EmbeddingIndex
+from app.painting_index import RERANK_CANDIDATES, PaintingIndex, index_params
+from benchmarks.preprocessing import expected_artwork
+
+# Offline benchmark of the recognition path, run from the backend folder:
+#   python -m benchmarks.recognition --gallery-size 500 --clients 4 --output run.json
+# The gallery is built from crawler images plus augmented copies of them, so
+# its size can go beyond the crawled collection. Recognition settings come from
+# the usual environment variables and are recorded in the report.
+# vote_recall and prefilter_recall compare the shortlists of the votes and of
+# the global descriptor with a full scan of every painting, see
+# RERANK_CANDIDATES in app/painting_index.py and PREFILTER_TOP_K in
+# app/recognition_pool.py.
+SYNTHETIC_ID_START = 10_000_000
+# Shortlist lengths reported in recall_at
+RECALL_AT = (1, 5, 10, 20, 50, 100)
+
+
+def augment(image, rng):
+    # A plausible other painting: rotated, rescaled, recoloured and cropped
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D(
+        (width / 2, height / 2), rng.uniform(-15, 15), rng.uniform(0.8, 1.2)
+    )
+    image = cv2.warpAffine(
+        image, matrix, (width, height), borderMode=cv2.BORDER_REFLECT
+    )
+    image = cv2.convertScaleAbs(
+        image, alpha=rng.uniform(0.7, 1.3), beta=rng.uniform(-30, 30)
+    )
+    top, left = int(rng.uniform(0, 0.15) * height), int(rng.uniform(0, 0.15) * width)
+    image = image[
+        top : height - int(rng.uniform(0, 0.15) * height),
+        left : width - int(rng.uniform(0, 0.15) * width),
+    ]
+    if rng.random() < 0.5:
+        image = cv2.flip(image, 1)
+    return image
+
+
+def build_gallery(source, output, size, queries, seed):
+    # Real paintings first, always including the ones the test photos show
+    rng = random.Random(seed)
+    expected = {expected_artwork(query) for query in queries}
+    real = sorted(source.glob("*.jpeg"))
+    real = [f for f in real if f.stem in expected] + [
+        f for f in real if f.stem not in expected
+    ]
+    for painting_file in real[:size]:
+        os.symlink(painting_file.resolve(), output / painting_file.name)
+    for i in range(max(0, size - len(real))):
+        image = cv2.imread(str(rng.choice(real)))
+        cv2.imwrite(str(output / f"{SYNTHETIC_ID_START + i}.jpeg"), augment(image, rng))
+    return sorted(output.glob("*.jpeg"))
+
+
+def extract(painting_file):
+    image = preprocessing.load(painting_file)
+    if image is None:
+        return None
+    kp, des = preprocessing.extract_features(image)
+    return keypoints_to_array(kp), des
+
+
+def build_store(files, store_dir):
+    with ThreadPoolExecutor() as executor:
+        features = list(executor.map(extract, files))
+    with FeatureStoreWriter(store_dir) as writer:
+        for painting_file, painting_features in zip(files, features):
+            if painting_features is not None:
+                writer.add(painting_file.name, *painting_features)
+    return FeatureStore.open(store_dir)
+
+
+def memory_mb():
+    # Memory of the calling process from /proc (Linux): the peak resident set,
+    # the proportional share of it and the pages only this process uses
+    fields = {}
+    for name in ("/proc/self/status", "/proc/self/smaps_rollup"):
+        with open(name) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[key] = int(value.split()[0])
+    return {
+        "pid": os.getpid(),
+        "peak_rss": fields["VmHWM"] // 1024,
+        "pss": fields["Pss"] // 1024,
+        "private": (fields["Private_Clean"] + fields["Private_Dirty"]) // 1024,
+    }
+
+
+def worker_memory_mb():
+    # Runs as a pool task. Keeps the worker busy for a moment, so the other
+    # calls of the same round go to the other workers.
+    time.sleep(0.2)
+    return memory_mb()
+
+
+async def workers_memory_mb():
+    loop = asyncio.get_running_loop()
+    pool = recognition_pool.get_executor()
+    workers = {}
+    for _ in range(5):
+        for memory in await asyncio.gather(
+            *(
+                loop.run_in_executor(pool, worker_memory_mb)
+                for _ in range(recognition_pool.RECOGNITION_WORKERS)
+            )
+        ):
+            workers[memory["pid"]] = memory
+        if len(workers) == recognition_pool.RECOGNITION_WORKERS:
+            break
+    return sorted(workers.values(), key=lambda memory: memory["pid"])
+
+
+def full_scan(painting_index, query_points, query_des):
+    # The painting an exhaustive per-painting comparison picks
+    scores = [
+        painting_index.painting_score(query_des, len(query_points), painting)
+        for painting in range(len(painting_index))
+    ]
+    return int(np.argmax(scores))
+
+
+def rank(scores, painting):
+    return int((scores > scores[painting]).sum()) + 1
+
+
+def recall_at(ranks):
+    return {
+        str(k): sum(r is not None and r <= k for r in ranks) / max(1, len(ranks))
+        for k in RECALL_AT
+    }
+
+
+def shortlist_recall(queries, store):
+    # Rank of the full scan's painting in the shortlists of every query: by
+    # the votes of the stacked index and by the global descriptor. recall_at[K]
+    # is the share of queries a shortlist of K candidates still matches like
+    # the full scan. Paintings without votes never make the vote shortlist.
+    painting_index = PaintingIndex.from_store(store)
+    embeddings = EmbeddingIndex.build(store)
+    vote_ranks, prefilter_ranks = [], []
+    for _, image_bytes in queries:
+        features = recognition_pool.extract(image_bytes)
+        if features is None or features[1] is None:
+            continue
+        query_points, query_des, image_shape = features
+        best = full_scan(painting_index, query_points, query_des)
+        votes = painting_index.votes(query_des)
+        vote_ranks.append(rank(votes, best) if votes[best] > 0 else None)
+        query_embedding = embeddings.embed_query(query_points, query_des, image_shape)
+        prefilter_ranks.append(rank(embeddings.embeddings @ query_embedding, best))
+    return (
+        {"ranks": vote_ranks, "recall_at": recall_at(vote_ranks)},
+        {"ranks": prefilter_ranks, "recall_at": recall_at(prefilter_ranks)},
+    )
+
+
+def percentiles(latencies):
+    return {f"p{p}": round(float(np.percentile(latencies, p)), 1) for p in (50, 95, 99)}
+
+
+async def measure(queries, store, clients, repeat):
+    store_dir, generation = str(store.path), store.generation
+
+    async def recognize(image_bytes):
+        start = time.perf_counter()
+        result = await recognition_pool.run(
+            recognition_pool.recognize, image_bytes, store_dir, generation
+        )
+        return result, (time.perf_counter() - start) * 1000
+
+    # Cold start: spawning the workers, mapping the store and the first query
+    start = time.perf_counter()
+    await recognize(queries[0][1])
+    cold_start = time.perf_counter() - start
+    # The other workers attach their index here, outside the measurements
+    await asyncio.gather(
+        *(recognize(queries[0][1]) for _ in range(recognition_pool.RECOGNITION_WORKERS))
+    )
+
+    latencies, correct = [], 0
+    for _ in range(repeat):
+        for expected, image_bytes in queries:
+            result, latency = await recognize(image_bytes)
+            latencies.append(latency)
+            correct += result is not None and result["similar_artwork_id"] == expected
+
+    jobs = [image_bytes for _ in range(repeat) for _, image_bytes in queries]
+    rejected = 0
+
+    async def client(jobs):
+        nonlocal rejected
+        for image_bytes in jobs:
+            try:
+                await recognize(image_bytes)
+            except HTTPException:
+                rejected += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(jobs) for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "memory_mb": {"main": memory_mb(), "workers": await workers_memory_mb()},
+        "cold_start_s": round(cold_start, 3),
+        "query_latency_ms": percentiles(latencies),
+        "top1_accuracy": correct / len(latencies),
+        "throughput": {
+            "clients": clients,
+            "queries": len(jobs) * clients,
+            "rejected": rejected,
+            "queries_per_s": round((len(jobs) * clients - rejected) / elapsed, 2),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    queries = sorted(args.queries.glob("*.jpg"))
+    queries = [
+        (expected_artwork(query), query.read_bytes())
+        for query in queries
+        if expected_artwork(query)
+    ]
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        gallery = workdir / "gallery"
+        gallery.mkdir()
+        files = build_gallery(
+            args.source,
+            gallery,
+            args.gallery_size,
+            args.queries.glob("*.jpg"),
+            args.seed,
+        )
+
+        start = time.perf_counter()
+        store = build_store(files, workdir / "feature_store")
+        store_build = time.perf_counter() - start
+        start = time.perf_counter()
+        cv2.flann_Index(np.ascontiguousarray(store.descriptors), index_params)
+        index_build = time.perf_counter() - start
+        vote_recall, prefilter_recall = shortlist_recall(queries, store)
+
+        # The workers are measured from the inside, so they have to be this
+        # process's pool and not a shared recognition service
+        recognition_pool.RECOGNITION_SERVICE = None
+        try:
+            metrics = asyncio.run(measure(queries, store, args.clients, args.repeat))
+        finally:
+            if recognition_pool.executor is not None:
+                recognition_pool.executor.shutdown(wait=True)
+                recognition_pool.executor = None
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "gallery_size": len(store),
+            "descriptors": len(store.descriptors),
+            "queries": len(queries),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "workers": recognition_pool.RECOGNITION_WORKERS,
+            "rerank_candidates": RERANK_CANDIDATES,
+            "prefilter_top_k": recognition_pool.PREFILTER_TOP_K,
+            "geometric_verification": recognition_pool.GEOMETRIC_VERIFICATION,
+            "preprocessing": preprocessing.default_settings.as_dict(),
+        },
+        "store_build_s": round(store_build, 3),
+        "index_build_s": round(index_build, 3),
+        "vote_recall": vote_recall,
+        "prefilter_recall": prefilter_recall,
+        **metrics,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark artwork recognition")
+    parser.add_argument(
+        "--source", type=Path, default=Path("../crawler/belvedere_images")
+    )
+    parser.add_argument("--queries", type=Path, default=Path("test_images"))
+    parser.add_argument("--gallery-size", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Times every test photo is queried"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    text = json.dumps(run(args), indent=2)
+    if args.output:
+        args.output.write_text(text)
+    print(text)
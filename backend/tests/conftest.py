@@ -0,0 +1,4 @@
+import os
+
+# app.database creates its engine on import
+os.environ.setdefault("DATABASE_URL", "sqlite://")
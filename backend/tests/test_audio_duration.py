@@ -0,0 +1,83 @@
+import struct
+import pytest
+from app.audio_uploads import audio_duration
+
+UNKNOWN_SIZE = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+
+
+def element(element_id, payload=b"", unknown_size=False):
+    if unknown_size:
+        return element_id + UNKNOWN_SIZE + payload
+    return element_id + (1 << 56 | len(payload)).to_bytes(8, "big") + payload
+
+
+def simple_block(timecode):
+    # Track 1, relative timecode, flags and some frame data
+    return element(b"\xa3", b"\x81" + struct.pack(">hB", timecode, 0x80) + b"opus")
+
+
+def webm(info, unknown_size=False):
+    clusters = b""
+    for cluster_time in (0, 1000, 2000):
+        blocks = b"".join(simple_block(offset) for offset in (0, 20, 980))
+        clusters += element(
+            b"\x1f\x43\xb6\x75",
+            element(b"\xe7", cluster_time.to_bytes(2, "big")) + blocks,
+            unknown_size,
+        )
+    header = element(b"\x1a\x45\xdf\xa3", element(b"\x42\x82", b"webm"))
+    segment = element(b"\x15\x49\xa9\x66", info) + clusters
+    return header + element(b"\x18\x53\x80\x67", segment, unknown_size)
+
+
+def box(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+@pytest.mark.parametrize("unknown_size", [False, True])
+def test_webm_without_duration_uses_the_last_block(tmp_path, unknown_size):
+    # Like MediaRecorder recordings: no Duration, timestamps in milliseconds
+    path = tmp_path / "recording.ogg"
+    info = element(b"\x2a\xd7\xb1", (1_000_000).to_bytes(3, "big"))
+    path.write_bytes(webm(info, unknown_size))
+    assert audio_duration(path) == pytest.approx(2.98)
+
+
+def test_webm_duration_element(tmp_path):
+    path = tmp_path / "recording.webm"
+    info = element(b"\x2a\xd7\xb1", (1_000_000).to_bytes(3, "big")) + element(
+        b"\x44\x89", struct.pack(">d", 3100.0)
+    )
+    path.write_bytes(webm(info))
+    assert audio_duration(path) == pytest.approx(3.1)
+
+
+def test_mp4_movie_header(tmp_path):
+    path = tmp_path / "recording.mp4"
+    mvhd = box(b"mvhd", b"\x00" * 12 + struct.pack(">II", 1000, 4500) + b"\x00" * 80)
+    path.write_bytes(box(b"ftyp", b"M4A \x00\x00\x00\x00") + box(b"moov", mvhd))
+    assert audio_duration(path) == pytest.approx(4.5)
+
+
+def test_wav(tmp_path):
+    path = tmp_path / "recording.wav"
+    fmt = struct.pack("<HHIIHH", 1, 1, 8000, 16000, 2, 16)
+    data = b"\x00" * 32000
+    path.write_bytes(
+        b"RIFF"
+        + struct.pack("<I", 36 + len(data))
+        + b"WAVE"
+        + b"fmt "
+        + struct.pack("<I", len(fmt))
+        + fmt
+        + b"data"
+        + struct.pack("<I", len(data))
+        + data
+    )
+    assert audio_duration(path) == pytest.approx(2.0)
+
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / "recording.mp3"
+    path.write_bytes(b"ID3" + b"\x00" * 100)
+    assert audio_duration(path) is None
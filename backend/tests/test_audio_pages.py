@@ -0,0 +1,58 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app import crud, models
+from app.database import Base
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(models.User(id=1, username="visitor", hashed_password="x"))
+    session.add(models.Image(id=1, url="u", title="t"))
+    session.commit()
+    yield session
+    session.close()
+
+
+def add_audios(db, count, created_at=None):
+    for i in range(count):
+        db.add(
+            models.Audio(
+                filename=f"audio_{i}", user_id=1, image_id=1, created_at=created_at
+            )
+        )
+    db.commit()
+
+
+def all_pages(page_function, limit):
+    ids, cursor = [], None
+    while True:
+        audios, cursor = page_function(cursor=cursor, limit=limit)
+        ids.extend(audio.id for audio in audios)
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize("limit", [1, 5, 12, 20])
+def test_pages_through_rows_of_the_same_second(db, limit):
+    add_audios(db, 12, created_at=datetime(2024, 9, 14, 17, 54, 28))
+    expected = list(range(1, 13))
+    assert (
+        all_pages(lambda **page: crud.get_audios_for_image(db, 1, **page), limit)
+        == expected
+    )
+    assert (
+        all_pages(lambda **page: crud.get_audios_for_user(db, 1, **page), limit)
+        == expected
+    )
+
+
+def test_pages_through_rows_with_default_timestamps(db):
+    add_audios(db, 12)
+    assert all_pages(
+        lambda **page: crud.get_audios_for_image(db, 1, **page), 5
+    ) == list(range(1, 13))
@@ -0,0 +1,71 @@
+import threading
+import time
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from app import models
+from app.audio_sync import reconcile_audio
+from app.audio_uploads import uploads_lock
+from app.database import Base
+
+FILENAME = "audio_1_1_20240914_175428_000000_abc.ogg"
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        session.add(models.User(id=1, username="visitor", hashed_password="x"))
+        session.add(models.Image(id=1, url="u", title="t"))
+        session.commit()
+    return Session
+
+
+def audio_rows(Session):
+    with Session() as session:
+        return session.execute(
+            select(models.Audio.id, models.Audio.filename).order_by(models.Audio.id)
+        ).all()
+
+
+def test_adds_files_and_removes_orphaned_rows(sessions, tmp_path):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    (uploads / FILENAME).write_bytes(b"audio")
+    with sessions() as session:
+        session.add(models.Audio(filename="audio_gone", user_id=1, image_id=1))
+        session.commit()
+        summary = reconcile_audio(session, uploads)
+    assert summary == {"added": 1, "removed": 1, "unchanged": 0, "skipped": 0}
+    assert [filename for _, filename in audio_rows(sessions)] == [FILENAME]
+
+
+def test_waits_for_uploads_in_progress(sessions, tmp_path):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    moved = threading.Event()
+    upload_id = []
+
+    def upload():
+        # Like upload_audio: the file is in place before its row is inserted
+        with uploads_lock(uploads, shared=True):
+            (uploads / FILENAME).write_bytes(b"audio")
+            moved.set()
+            time.sleep(0.2)
+            with sessions() as session:
+                audio = models.Audio(filename=FILENAME, user_id=1, image_id=1)
+                session.add(audio)
+                session.commit()
+                upload_id.append(audio.id)
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+    moved.wait()
+    with sessions() as session:
+        summary = reconcile_audio(session, uploads)
+    thread.join()
+
+    assert summary["added"] == 0
+    assert audio_rows(sessions) == [(upload_id[0], FILENAME)]
@@ -0,0 +1,81 @@
+from pathlib import Path
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+from app import crud, models
+
+ALEMBIC_INI = Path(__file__).resolve().parent.parent / "alembic.ini"
+
+
+def upgrade(engine):
+    config = Config(str(ALEMBIC_INI))
+    config.set_main_option("script_location", str(ALEMBIC_INI.parent / "alembic"))
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+
+
+def schema_differences(engine):
+    with engine.connect() as connection:
+        return compare_metadata(
+            MigrationContext.configure(connection), models.Base.metadata
+        )
+
+
+def test_migrations_create_the_models_schema():
+    engine = create_engine("sqlite://")
+    upgrade(engine)
+    assert schema_differences(engine) == []
+
+
+def test_migrations_adopt_a_database_made_by_create_all():
+    # Tables created before the migrations, without the later additions
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY)"))
+        connection.execute(text("CREATE TABLE images (id INTEGER PRIMARY KEY)"))
+        connection.execute(
+            text(
+                "CREATE TABLE audios (id INTEGER PRIMARY KEY, filename VARCHAR, "
+                "user_id INTEGER, image_id INTEGER, created_at DATETIME)"
+            )
+        )
+    upgrade(engine)
+    inspector = inspect(engine)
+    assert "content_hash" in {c["name"] for c in inspector.get_columns("audios")}
+    assert {
+        "ix_audios_image_created_id",
+        "ix_audios_user_created_id",
+        "ix_audios_content_hash",
+    } <= {index["name"] for index in inspector.get_indexes("audios")}
+    # Running them again changes nothing
+    upgrade(engine)
+
+
+def test_migrations_give_whole_second_timestamps_microseconds():
+    engine = create_engine("sqlite://")
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id) VALUES (1)"))
+        connection.execute(text("INSERT INTO images (id) VALUES (1)"))
+        for _ in range(3):
+            connection.execute(
+                text(
+                    "INSERT INTO audios (image_id, user_id, created_at) "
+                    "VALUES (1, 1, '2024-09-14 17:54:28')"
+                )
+            )
+        connection.execute(text("DELETE FROM alembic_version"))
+        connection.execute(text("INSERT INTO alembic_version VALUES ('c5d7e9f1a303')"))
+    upgrade(engine)
+
+    with Session(engine) as db:
+        audios, cursor = crud.get_audios_for_image(db, 1, limit=1)
+        ids = [audio.id for audio in audios]
+        while cursor is not None:
+            audios, cursor = crud.get_audios_for_image(db, 1, cursor=cursor, limit=1)
+            ids.extend(audio.id for audio in audios)
+    assert ids == [1, 2, 3]
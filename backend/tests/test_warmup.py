@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from app import warmup
+
+
+@pytest.fixture(autouse=True)
+def clean_subsystems():
+    warmup.subsystems.clear()
+    warmup.tasks.clear()
+    yield
+    warmup.subsystems.clear()
+    warmup.tasks.clear()
+
+
+def fail():
+    raise RuntimeError("broken")
+
+
+def warm_up(*subsystems):
+    async def run():
+        for name, function, required in subsystems:
+            warmup.start(name, function, required)
+        await asyncio.gather(*warmup.tasks)
+
+    asyncio.run(run())
+
+
+def test_failed_warmup_is_ready_after_lazy_retry():
+    warm_up(("features", fail, True))
+    assert not warmup.is_ready()
+    # A failed warm-up lets requests through to retry the work
+    warmup.require("features")
+
+    warmup.mark_ready("features")
+    assert warmup.is_ready()
+    assert warmup.subsystems["features"].as_dict()["state"] == "ready"
+
+
+def test_optional_subsystem_does_not_block_readiness():
+    warm_up(("features", lambda: None, True), ("audio", fail, False))
+    assert warmup.is_ready()
+    audio = warmup.subsystems["audio"].as_dict()
+    assert (audio["state"], audio["error"], audio["required"]) == (
+        "failed",
+        "broken",
+        False,
+    )
+
+
+def test_mark_ready_ignores_unknown_subsystems():
+    warmup.mark_ready("features")
+    assert warmup.subsystems == {}
+    assert warmup.is_ready()
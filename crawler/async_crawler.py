@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from urllib.parse import urlsplit
+import httpx
+from crawl_state import STATE_FILE, CrawlState
+from crawler import (
+    artwork_id,
+    headers,
+    listing_url,
+    parse_artwork,
+    parse_artwork_links,
+    parse_page_limit,
+)
+
+# Crawl mode on asyncio (python crawler.py --async). Listing pages, artwork
+# pages and image downloads are independent jobs on one queue, worked off by
+# a fixed number of workers sharing one pooled HTTP client. Requests to each
+# host go through a token bucket and are retried with exponential back-off on
+# 429, 5xx and connection errors.
+# Re-crawls are incremental: pages and images are requested conditionally
+# with the validators kept in the crawl state (crawl_state.py), and only
+# artworks whose metadata changed are sent to the backend.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average and bursts of `burst`
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCrawler:
+    def __init__(
+        self,
+        token,
+        api_url="http://localhost:8000",
+        concurrency=16,
+        rate=5.0,
+        burst=10,
+        retries=5,
+        batch_size=100,
+        state_file=STATE_FILE,
+    ):
+        self.token = token
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.batch_size = batch_size
+        self.buckets = {}
+        self.queue = asyncio.Queue()
+        self.artwork_buffer = []
+        self.state = CrawlState.load(state_file)
+        self.seen_artworks = set()
+        self.listing_failed = False
+        self.stats = {
+            "pages": 0,
+            "artworks": 0,
+            "stored": 0,
+            "images": 0,
+            "removed": 0,
+            "failed": 0,
+        }
+        self.client = None
+
+    async def fetch(self, url, headers=None):
+        return await self.request("GET", url, headers=headers)
+
+    async def request(self, method, url, **kwargs):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        for attempt in range(self.retries + 1):
+            await self.buckets[host].acquire()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Request to {url} failed: {e!r}")
+                delay = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    # 304 answers conditional requests, see fetch_changed
+                    if response.status_code != 304:
+                        response.raise_for_status()
+                    return response
+                if attempt == self.retries:
+                    response.raise_for_status()
+                retry_after = response.headers.get("retry-after", "")
+                delay = float(retry_after) if retry_after.isdigit() else None
+                logging.warning(f"{url} answered {response.status_code}, retrying")
+            if delay is None:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+                delay *= random.uniform(0.5, 1.5)
+            await asyncio.sleep(delay)
+
+    async def fetch_changed(self, url, cached=True):
+        # Conditional GET with the validators of the last crawl if there is a
+        # cached copy. Returns None if nothing changed since, else the response,
+        # which the caller records in the crawl state once it has stored it.
+        headers = self.state.conditional_headers(url) if cached else {}
+        response = await self.fetch(url, headers)
+        if response.status_code == 304:
+            self.state.not_modified(url)
+            return None
+        if cached and not self.state.changed(url, response):
+            self.state.update(url, response)
+            return None
+        return response
+
+    async def crawl_listing(self, page):
+        url = listing_url(page)
+        links = self.state.links(url)
+        response = await self.fetch_changed(url, cached=links is not None)
+        if response is not None:
+            links = await asyncio.to_thread(parse_artwork_links, response.content)
+            self.state.update(url, response)
+            self.state.set_links(url, links)
+        self.stats["pages"] += 1
+        for artwork_url in links:
+            self.queue.put_nowait((self.crawl_artwork, artwork_url))
+
+    async def crawl_artwork(self, url):
+        id = artwork_id(url)
+        self.seen_artworks.add(id)
+        self.state.artwork_seen(id)
+        file_name = f"belvedere_data/{id}.json"
+        cached = None
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                cached = json.load(f)
+
+        # The crawl state only knows artworks the backend has accepted. The
+        # metadata cache alone does not count, it is checked in with the repo
+        # and says nothing about the backend this crawl writes to.
+        stored = cached is not None and self.state.known(url)
+        response = await self.fetch_changed(url, stored)
+        data = cached
+        if response is not None:
+            data = await asyncio.to_thread(parse_artwork, response.content, url)
+        self.stats["artworks"] += 1
+        self.queue.put_nowait((self.download_image, (id, data["url"])))
+        if stored and data == cached:
+            if response is not None:
+                self.state.update(url, response)
+            logging.info(f"Metadata unchanged: {file_name}")
+        else:
+            self.stats["stored"] += 1
+            self.artwork_buffer.append(({"id": int(id), **data}, url, response))
+            if len(self.artwork_buffer) >= self.batch_size:
+                await self.flush_artworks()
+
+    async def download_image(self, job):
+        id, image_url = job
+        file_name = f"belvedere_images/{id}.jpeg"
+        response = await self.fetch_changed(image_url, os.path.exists(file_name))
+        if response is None:
+            logging.info(f"Stored artwork (file cached): {file_name}")
+            return
+        # Written under a temporary name, an interrupted run leaves no
+        # truncated image that would be taken for a cached one
+        partial_name = f"{file_name}.part"
+        with open(partial_name, "wb") as f:
+            f.write(response.content)
+        os.replace(partial_name, file_name)
+        self.state.update(image_url, response)
+        self.stats["images"] += 1
+        logging.info(f"Stored artwork: {file_name}")
+
+    async def flush_artworks(self):
+        # The bulk upsert is idempotent, so a failed batch is retried like a
+        # fetch. If it still fails, neither the metadata cache nor the crawl
+        # state take its artworks and the next run sends them again.
+        batch, self.artwork_buffer = self.artwork_buffer, []
+        if not batch:
+            return
+        try:
+            api_response = await self.request(
+                "POST",
+                f"{self.api_url}/images/bulk",
+                headers={"Authorization": f"Bearer {self.token}"},
+                json=[record for record, _, _ in batch],
+            )
+        except httpx.HTTPError as e:
+            self.stats["failed"] += len(batch)
+            logging.error(f"Storing {len(batch)} artworks on backend failed: {e!r}")
+            return
+        logging.info(f"Stored {len(batch)} artworks on backend: {api_response.json()}")
+        for record, url, response in batch:
+            data = {key: value for key, value in record.items() if key != "id"}
+            with open(f"belvedere_data/{record['id']}.json", "w") as f:
+                json.dump(data, f, indent=2)
+            self.state.update(url, response)
+
+    async def worker(self):
+        while True:
+            job, argument = await self.queue.get()
+            try:
+                await job(argument)
+            except Exception as e:
+                self.stats["failed"] += 1
+                if job == self.crawl_listing:
+                    self.listing_failed = True
+                logging.error(f"{job.__name__}({argument}) failed: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        os.makedirs("belvedere_data", exist_ok=True)
+        os.makedirs("belvedere_images", exist_ok=True)
+        limits = httpx.Limits(
+            max_connections=self.concurrency, max_keepalive_connections=self.concurrency
+        )
+        async with httpx.AsyncClient(
+            headers=headers, limits=limits, timeout=30, follow_redirects=True
+        ) as self.client:
+            response = await self.fetch(listing_url())
+            page_limit = parse_page_limit(response.content)
+            logging.info(f"Crawling {page_limit} gallery pages")
+            for page in range(1, page_limit + 1):
+                self.queue.put_nowait((self.crawl_listing, page))
+
+            workers = [
+                asyncio.create_task(self.worker()) for _ in range(self.concurrency)
+            ]
+            try:
+                await self.queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                await self.flush_artworks()
+                self.state.save()
+
+        # Only a complete listing tells which artworks are no longer on view
+        if not self.listing_failed:
+            removed = self.state.mark_removed(self.seen_artworks)
+            self.stats["removed"] = len(removed)
+            if removed:
+                logging.info(f"No longer on view: {', '.join(sorted(removed))}")
+            self.state.save()
+        logging.info(f"Crawl finished: {self.stats}")
+        return self.stats
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+from bs4 import FeatureNotFound
+import async_crawler
+import crawler
+from fixtures import FIXTURES_DIR, INDEX_FILE, serve
+
+# Crawler throughput benchmark against the replay server, no requests leave
+# the machine:
+#   python fixtures.py record --pages 3
+#   python benchmark.py --parsers html.parser lxml --latency 0.05 --output run.json
+# For every parser it times the parsing of the recorded pages on their own and
+# a full async crawl, splitting the crawler's CPU time into parsing and the
+# rest (HTTP, queueing, file writes).
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(fixtures_dir, port, **options):
+    server = multiprocessing.Process(
+        target=serve, args=(fixtures_dir, port), kwargs=options, daemon=True
+    )
+    server.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("Replay server did not start")
+
+
+def recorded_pages(fixtures_dir):
+    # (kind, url, body) of the recorded HTML pages
+    with open(fixtures_dir / INDEX_FILE) as f:
+        index = json.load(f)
+    pages = []
+    for key, entry in index.items():
+        if "html" not in (entry["content_type"] or ""):
+            continue
+        if not key.startswith("/objects/images"):
+            kind = "artwork"
+        else:
+            # The first gallery page only tells the page count
+            kind = "listing" if "page=" in key else "page_count"
+        pages.append((kind, key, (fixtures_dir / entry["file"]).read_bytes()))
+    return pages
+
+
+def time_parsing(pages, repeat):
+    timings = {"page_count": [], "listing": [], "artwork": []}
+    for _ in range(repeat):
+        for kind, url, body in pages:
+            start = time.process_time()
+            if kind == "page_count":
+                crawler.parse_page_limit(body)
+            elif kind == "listing":
+                crawler.parse_artwork_links(body)
+            else:
+                crawler.parse_artwork(body, crawler.base_url + url)
+            timings[kind].append((time.process_time() - start) * 1000)
+    return {
+        f"{kind}_ms": round(sum(values) / len(values), 2)
+        for kind, values in timings.items()
+        if values
+    }
+
+
+def timed(function, totals, lock):
+    # Adds the CPU time of the calling thread spent in function to totals
+    def wrapper(*args):
+        start = time.thread_time()
+        try:
+            return function(*args)
+        finally:
+            with lock:
+                totals["parse"] += time.thread_time() - start
+
+    return wrapper
+
+
+def crawl(args, base_url):
+    totals = {"parse": 0.0}
+    lock = threading.Lock()
+    originals = {
+        name: getattr(async_crawler, name)
+        for name in ("parse_artwork", "parse_artwork_links", "parse_page_limit")
+    }
+    for name, function in originals.items():
+        setattr(async_crawler, name, timed(function, totals, lock))
+
+    before = httpx.get(f"{base_url}/_stats").json()
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            crawl = async_crawler.AsyncCrawler(
+                "benchmark",
+                api_url=base_url,
+                concurrency=args.concurrency,
+                rate=args.rate,
+                burst=max(1, int(args.rate)),
+                batch_size=args.batch_size,
+            )
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            stats = asyncio.run(crawl.run())
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+    finally:
+        os.chdir(cwd)
+        for name, function in originals.items():
+            setattr(async_crawler, name, function)
+    after = httpx.get(f"{base_url}/_stats").json()
+
+    transferred = after["bytes"] - before["bytes"]
+    return {
+        "wall_s": round(wall, 3),
+        "pages_per_s": round(stats["pages"] / wall, 2),
+        "artworks_per_s": round(stats["artworks"] / wall, 2),
+        "bytes_per_s": round(transferred / wall),
+        "requests": after["requests"] - before["requests"] - 1,
+        "cpu_s": round(cpu, 3),
+        "parse_cpu_s": round(totals["parse"], 3),
+        "other_cpu_s": round(cpu - totals["parse"], 3),
+        "crawl": stats,
+    }
+
+
+def run(args):
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = start_server(
+        args.fixtures,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+    )
+    pages = recorded_pages(args.fixtures)
+    crawler.base_url = base_url
+    results = {}
+    try:
+        for parser in args.parsers:
+            crawler.html_parser = parser
+            try:
+                results[parser] = {
+                    "parse": time_parsing(pages, args.repeat),
+                    **crawl(args, base_url),
+                }
+            except FeatureNotFound:
+                results[parser] = {"error": f"{parser} is not installed"}
+    finally:
+        server.terminate()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "fixtures": len(pages),
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "rate_limit": args.rate_limit,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the crawler offline")
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_DIR)
+    parser.add_argument("--parsers", nargs="+", default=["html.parser", "lxml"])
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--rate", type=float, default=1000, help="Crawler requests per second"
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Server side limit, 0 is none"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Passes over the pages when timing parsing",
+    )
+    parser.add_argument("--output", type=Path, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    print(text)
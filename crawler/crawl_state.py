@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+# Manifest of what the last crawls saw, so a re-crawl only downloads and
+# stores what changed. Per URL (gallery page, artwork page, image) it keeps
+# the validators for conditional requests, a hash of the body and when it was
+# last seen; per artwork id when it was last on view and, once it is no
+# longer listed, when it was removed.
+STATE_FILE = "crawl_state.json"
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class CrawlState:
+    def __init__(self, path, resources=None, artworks=None):
+        self.path = path
+        self.resources = resources or {}
+        self.artworks = artworks or {}
+
+    @classmethod
+    def load(cls, path=STATE_FILE):
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            state = json.load(f)
+        return cls(path, state.get("resources"), state.get("artworks"))
+
+    def save(self):
+        partial_name = f"{self.path}.part"
+        with open(partial_name, "w") as f:
+            json.dump(
+                {"resources": self.resources, "artworks": self.artworks}, f, indent=1
+            )
+        os.replace(partial_name, self.path)
+
+    def conditional_headers(self, url):
+        entry = self.resources.get(url, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def not_modified(self, url):
+        # Answer of a 304, the stored entry stays valid
+        self.resources[url]["last_seen"] = now()
+
+    def known(self, url):
+        # True once a 200 answer for url was recorded
+        return "hash" in self.resources.get(url, {})
+
+    def changed(self, url, response):
+        # False if the body of a 200 answer is the same as last time (servers
+        # without validators)
+        return self.resources.get(url, {}).get("hash") != content_hash(response.content)
+
+    def update(self, url, response):
+        # Records a 200 answer. Only done once what it carries is stored, so
+        # a later conditional request cannot skip content that was lost.
+        entry = self.resources.setdefault(url, {})
+        entry.update(
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+            hash=content_hash(response.content),
+            last_seen=now(),
+        )
+
+    def links(self, url):
+        return self.resources.get(url, {}).get("links")
+
+    def set_links(self, url, links):
+        self.resources[url]["links"] = links
+
+    def artwork_seen(self, id):
+        self.artworks[id] = {"last_seen": now(), "removed_at": None}
+
+    def mark_removed(self, seen_ids):
+        # Artworks on view before but not listed this time, returns their ids
+        removed = []
+        for id, entry in self.artworks.items():
+            if id not in seen_ids and entry.get("removed_at") is None:
+                entry["removed_at"] = now()
+                removed.append(id)
+        return removed
@@ -6,6 +6,8 @@ import os
 from urllib.parse import urljoin
 import concurrent.futures
 import logging
+import sys
+import threading
 
 # Set up logging
 logging.basicConfig(
@@ -14,17 +16,89 @@ logging.basicConfig(
 
 token = ""
 base_url = "https://sammlung.belvedere.at"
+# BeautifulSoup parser backend, "lxml" is faster if it is installed
+html_parser = "html.parser"
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 }
 session = requests.Session()
 api_session = requests.Session()
 
+# Artworks waiting to be sent to the backend
+batch_size = 100
+artwork_buffer = []
+artwork_buffer_lock = threading.Lock()
 
-def crawl_belvedere_collection(single_threaded: bool = False):
-    gallery_url = (
+
+def listing_url(page=None):
+    url = (
         f"{base_url}/objects/images?filter=locationssite:Oberes%20Belvedere;onview:true"
     )
+    return url if page is None else f"{url}&page={page}"
+
+
+def artwork_id(url):
+    return url.split("/")[4]
+
+
+def parse_page_limit(content):
+    soup = BeautifulSoup(content, html_parser)
+    return int(soup.find("span", class_="max-pages").text[2:].strip().replace(".", ""))
+
+
+def parse_artwork_links(content):
+    soup = BeautifulSoup(content, html_parser)
+    artworks = soup.find_all("div", class_="grid-item")
+    logging.info(f"Found {len(artworks)} artwork items on the gallery page")
+
+    if not artworks:
+        logging.warning(
+            "No artwork items found. The page structure might have changed."
+        )
+        logging.info(
+            f"Page content: {soup.prettify()[:500]}..."
+        )  # Log first 500 characters of the page
+
+    links = []
+    for artwork in artworks:
+        link = artwork.find("a", href=True)
+        if link:
+            links.append(urljoin(base_url, link["href"]))
+        else:
+            logging.warning(f"No link found for artwork: {artwork}")
+    return links
+
+
+def parse_artwork(content, url):
+    # The metadata of an artwork page, as cached in belvedere_data
+    soup = BeautifulSoup(content, html_parser)
+
+    # Extract detailed information
+    title = soup.find("h1")
+    title = title.text.strip() if title else "Unknown Title"
+
+    artistDiv = soup.find("div", class_="peopleField")
+    artistAnchor = artistDiv.find("a")
+    artist = artistAnchor.text.strip() if artistAnchor else "Unknown Artist"
+
+    description = ""
+    if soup.find("li", class_="descriptionField"):
+        description = soup.find("li", class_="descriptionField").find("p").text.strip()
+
+    image_url = (
+        base_url + soup.find("div", class_="detail-item-img").find("img").attrs["src"]
+    )
+    return {
+        "url": image_url,
+        "title": title,
+        "description": description,
+        "description_page": url,
+        "artist": artist,
+    }
+
+
+def crawl_belvedere_collection(single_threaded: bool = False):
+    gallery_url = listing_url()
 
     try:
         response = session.get(gallery_url, headers=headers)
@@ -34,10 +108,7 @@ def crawl_belvedere_collection(single_threaded: bool = False):
         logging.error(f"Failed to access gallery page: {e}")
         return
 
-    soup = BeautifulSoup(response.content, "html.parser")
-    page_limit = int(
-        soup.find("span", class_="max-pages").text[2:].strip().replace(".", "")
-    )
+    page_limit = parse_page_limit(response.content)
 
     if single_threaded:
         for page in range(1, page_limit + 1):
@@ -58,7 +129,7 @@ def crawl_belvedere_collection(single_threaded: bool = False):
 
 
 def crawl_belvedere_collection_page(page: int):
-    gallery_url = f"{base_url}/objects/images?filter=locationssite:Oberes%20Belvedere;onview:true&page={page}"
+    gallery_url = listing_url(page)
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
     }
@@ -70,33 +141,15 @@ def crawl_belvedere_collection_page(page: int):
         logging.error(f"Failed to access gallery page: {e}")
         return
 
-    soup = BeautifulSoup(response.content, "html.parser")
-
     if not os.path.exists("belvedere_images"):
         os.makedirs("belvedere_images")
 
-    artworks = soup.find_all("div", class_="grid-item")
-    logging.info(f"Found {len(artworks)} artwork items on the gallery page")
-
-    if not artworks:
-        logging.warning(
-            "No artwork items found. The page structure might have changed."
-        )
-        logging.info(
-            f"Page content: {soup.prettify()[:500]}..."
-        )  # Log first 500 characters of the page
-
-    for artwork in artworks:
-        link = artwork.find("a", href=True)
-        if link:
-            artwork_url = urljoin(base_url, link["href"])
-            crawl_artwork_page(artwork_url, headers)
-        else:
-            logging.warning(f"No link found for artwork: {artwork}")
+    for artwork_url in parse_artwork_links(response.content):
+        crawl_artwork_page(artwork_url, headers)
 
 
 def crawl_artwork_page(url, headers):
-    id = url.split("/")[4]
+    id = artwork_id(url)
     file_name = f"belvedere_data/{id}.json"
 
     if os.path.exists(file_name):
@@ -119,41 +172,24 @@ def crawl_artwork_page(url, headers):
         logging.error(f"Failed to access artwork page {url}: {e}")
         return
 
-    soup = BeautifulSoup(response.content, "html.parser")
-
-    # Extract detailed information
-    title = soup.find("h1")
-    title = title.text.strip() if title else "Unknown Title"
-
-    artistDiv = soup.find("div", class_="peopleField")
-    artistAnchor = artistDiv.find("a")
-    artist = artistAnchor.text.strip() if artistAnchor else "Unknown Artist"
-
-    description = ""
-    if soup.find("li", class_="descriptionField"):
-        description = soup.find("li", class_="descriptionField").find("p").text.strip()
-
-    image_url = (
-        base_url + soup.find("div", class_="detail-item-img").find("img").attrs["src"]
-    )
-
+    cache_data = parse_artwork(response.content, url)
     with open(file_name, "w") as f:
-        cache_data = {
-            "url": image_url,
-            "title": title,
-            "description": description,
-            "description_page": url,
-            "artist": artist,
-        }
         json.dump(cache_data, f, indent=2)
 
-    store_artwork(title, artist, description, url, image_url)
+    store_artwork(
+        cache_data["title"],
+        cache_data["artist"],
+        cache_data["description"],
+        url,
+        cache_data["url"],
+    )
 
 
 def store_artwork(name, artist, description, url, image_url):
-    # Post to the db
-    id = url.split("/")[4]
+    # Queue the metadata for the db, it is sent in batches by flush_artworks
+    id = artwork_id(url)
     data = {
+        "id": int(id),
         "url": image_url,
         "title": name,
         "description": description,
@@ -161,21 +197,11 @@ def store_artwork(name, artist, description, url, image_url):
         "artist": artist,
     }
 
-    api_headers = {
-        "accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}",  # Include the token in the Authorization header
-    }
-
-    api_response = api_session.post(
-        f"http://localhost:8000/images/{id}", headers=api_headers, json=data
-    )
-    if api_response.status_code == 200:
-        pass
-    elif api_response.status_code == 409:
-        logging.info(f"Artwork {id} already existed on backend")
-    else:
-        api_response.raise_for_status()
+    with artwork_buffer_lock:
+        artwork_buffer.append(data)
+        full = len(artwork_buffer) >= batch_size
+    if full:
+        flush_artworks()
 
     # Store the image in a folder
     file_name = f"belvedere_images/{id}.jpeg"
@@ -196,6 +222,27 @@ def store_artwork(name, artist, description, url, image_url):
     logging.info(f"Stored artwork: {file_name}")
 
 
+def flush_artworks():
+    # Post the queued artworks to the db, existing ones are updated
+    with artwork_buffer_lock:
+        batch = artwork_buffer[:]
+        artwork_buffer.clear()
+    if not batch:
+        return
+
+    api_headers = {
+        "accept": "application/json",
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}",  # Include the token in the Authorization header
+    }
+
+    api_response = api_session.post(
+        "http://localhost:8000/images/bulk", headers=api_headers, json=batch
+    )
+    api_response.raise_for_status()
+    logging.info(f"Stored {len(batch)} artworks on backend: {api_response.json()}")
+
+
 def login_backend():
     global token
 
@@ -224,13 +271,80 @@ def login_backend():
 
 
 if __name__ == "__main__":
+    # async_crawler imports this file as "crawler", it has to see the same
+    # settings (base_url, html_parser, token) as this script
+    sys.modules["crawler"] = sys.modules[__name__]
+
     parser = argparse.ArgumentParser(description="Crawl the Belvedere Collection")
     parser.add_argument(
         "--single-threaded",
         action="store_true",
         help="Run the crawler in single-threaded mode (easier for debugging)",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=batch_size,
+        help="Number of artworks sent to the backend per request",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Crawl with asyncio, artwork pages and images are fetched independently",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="Requests in flight at once (async mode)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5.0,
+        help="Requests per second per host (async mode)",
+    )
+    parser.add_argument(
+        "--postprocess",
+        action="store_true",
+        help="Compute thumbnails and features of the images after the crawl",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=base_url,
+        help="Collection to crawl, e.g. a local replay server (see fixtures.py)",
+    )
+    parser.add_argument(
+        "--parser",
+        default=html_parser,
+        help='BeautifulSoup parser, "html.parser" or "lxml"',
+    )
     args = parser.parse_args()
+    batch_size = args.batch_size
+    base_url = args.base_url.rstrip("/")
+    html_parser = args.parser
 
     login_backend()
-    crawl_belvedere_collection(single_threaded=args.single_threaded)
+    if args.use_async:
+        import asyncio
+        from async_crawler import AsyncCrawler
+
+        crawler = AsyncCrawler(
+            token,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            burst=max(1, int(args.rate * 2)),
+            batch_size=batch_size,
+        )
+        asyncio.run(crawler.run())
+    else:
+        try:
+            crawl_belvedere_collection(single_threaded=args.single_threaded)
+        finally:
+            flush_artworks()
+
+    if args.postprocess:
+        from postprocess import postprocess
+
+        postprocess()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+import requests
+
+# Offline copy of part of the collection, for benchmarks and debugging
+# without hitting sammlung.belvedere.at.
+#   python fixtures.py record --pages 3
+#   python fixtures.py serve --latency 0.05 --error-rate 0.02 --rate-limit 50
+#   python crawler.py --async --base-url http://127.0.0.1:8765
+# A fixture set is a folder of response bodies and index.json, which maps the
+# path and query of every recorded URL to its body file and content type.
+FIXTURES_DIR = Path("fixtures")
+INDEX_FILE = "index.json"
+
+
+def fixture_key(url):
+    parts = urlsplit(url)
+    key = unquote(parts.path)
+    return f"{key}?{unquote(parts.query)}" if parts.query else key
+
+
+def record(output=FIXTURES_DIR, pages=2):
+    # Records the first gallery pages with their artwork pages and images.
+    # Links to the collection are made relative and the page count is set to
+    # the recorded pages, so a crawl against the replay server stays inside
+    # the fixtures.
+    import crawler
+
+    output.mkdir(parents=True, exist_ok=True)
+    session = requests.Session()
+    session.headers.update(crawler.headers)
+    index = {}
+
+    def save(url, rewrite=None):
+        response = session.get(url)
+        response.raise_for_status()
+        content = response.content
+        if rewrite is not None:
+            content = rewrite(content.decode()).encode()
+        file_name = f"{len(index):05d}.bin"
+        (output / file_name).write_bytes(content)
+        index[fixture_key(url)] = {
+            "file": file_name,
+            "content_type": response.headers.get("content-type"),
+        }
+        logging.info(f"Recorded {url} ({len(content)} bytes)")
+        return content
+
+    def relative(html):
+        return html.replace(crawler.base_url, "")
+
+    save(
+        crawler.listing_url(),
+        lambda html: re.sub(
+            r'(<span[^>]*class="max-pages"[^>]*>)[^<]*',
+            rf"\g<1>/ {pages}",
+            relative(html),
+        ),
+    )
+    for page in range(1, pages + 1):
+        content = save(crawler.listing_url(page), relative)
+        for artwork_url in crawler.parse_artwork_links(content):
+            data = crawler.parse_artwork(save(artwork_url, relative), artwork_url)
+            save(data["url"])
+
+    with open(output / INDEX_FILE, "w") as f:
+        json.dump(index, f, indent=1)
+    logging.info(f"Recorded {len(index)} responses to {output}")
+
+
+class ReplayServer(ThreadingHTTPServer):
+    # Serves a fixture set. latency seconds are added to every request,
+    # error_rate of them fail with a 503 and more than rate_limit requests per
+    # second (0 for no limit) are answered with a 429. ETags make conditional
+    # requests work. POST /images/bulk stands in for the backend and
+    # GET /_stats returns the request and byte counts.
+    daemon_threads = True
+
+    def __init__(
+        self, address, fixtures_dir, latency=0.0, error_rate=0.0, rate_limit=0
+    ):
+        super().__init__(address, ReplayHandler)
+        with open(fixtures_dir / INDEX_FILE) as f:
+            index = json.load(f)
+        self.responses = {}
+        for key, entry in index.items():
+            body = (fixtures_dir / entry["file"]).read_bytes()
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self.responses[key] = (body, entry["content_type"], etag)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "statuses": {}}
+
+    def take_token(self):
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def count(self, status, size):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            statuses = self.stats["statuses"]
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, status, body=b"", content_type=None, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status, len(body))
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/_stats":
+            body = json.dumps(server.stats).encode()
+            return self.respond(200, body, "application/json")
+        if server.latency:
+            time.sleep(server.latency)
+        if not server.take_token():
+            return self.respond(429, headers={"Retry-After": "1"})
+        if random.random() < server.error_rate:
+            return self.respond(503)
+
+        response = server.responses.get(fixture_key(self.path))
+        if response is None:
+            return self.respond(404)
+        body, content_type, etag = response
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, headers={"ETag": etag})
+        self.respond(200, body, content_type, {"ETag": etag})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != "/images/bulk":
+            return self.respond(404)
+        result = {"created": len(json.loads(body)), "updated": 0, "unchanged": 0}
+        self.respond(200, json.dumps(result).encode(), "application/json")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(fixtures_dir=FIXTURES_DIR, port=8765, **options):
+    server = ReplayServer(("127.0.0.1", port), fixtures_dir, **options)
+    logging.info(f"Replaying {len(server.responses)} responses on port {port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Record and replay crawl fixtures")
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="Record from the collection")
+    record_parser.add_argument("--pages", type=int, default=2)
+    serve_parser = commands.add_parser("serve", help="Serve recorded fixtures")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every request"
+    )
+    serve_parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction answered with 503"
+    )
+    serve_parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Requests per second, 0 is none"
+    )
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.fixtures, args.pages)
+    else:
+        serve(
+            args.fixtures,
+            args.port,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            rate_limit=args.rate_limit,
+        )
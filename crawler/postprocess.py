@@ -0,0 +1,170 @@
+import argparse
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import cv2
+
+# Post-download stage: turns the crawled images into what the backend and the
+# frontend use, in a process pool. It writes web thumbnails to
+# belvedere_thumbnails/{width}/{id}.jpeg and the SIFT features straight into
+# the backend's feature store, so the backend finds them up to date and does
+# not extract anything at start.
+# The preprocessing settings (DECODE_REDUCTION, MAX_IMAGE_EDGE,
+# NORMALIZE_CONTRAST, MAX_KEYPOINTS) are read from the environment and have to
+# be the same as the backend's, features computed with other settings are
+# ignored there.
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app import preprocessing
+from app.feature_store import (
+    FeatureStore,
+    FeatureStoreError,
+    FeatureStoreWriter,
+    content_hash,
+    keypoints_to_array,
+    store_lock,
+)
+
+IMAGES_FOLDER = Path("belvedere_images")
+THUMBNAILS_FOLDER = Path("belvedere_thumbnails")
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_QUALITY = 80
+FEATURE_STORE_DIR = BACKEND_DIR / "feature_store"
+STORE_LOCK_FILE = BACKEND_DIR / "feature_store.lock"
+
+
+def source_of(path):
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def process_image(path):
+    # Runs in a worker process, returns the keypoints and descriptors of the
+    # image or None if it cannot be decoded
+    name = Path(path).stem
+    image = cv2.imread(str(path))
+    if image is None:
+        return None
+    for width in THUMBNAIL_WIDTHS:
+        if width < image.shape[1]:
+            height = round(image.shape[0] * width / image.shape[1])
+            thumbnail = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        else:
+            thumbnail = image
+        thumbnail_file = THUMBNAILS_FOLDER / str(width) / f"{name}.jpeg"
+        cv2.imwrite(
+            str(thumbnail_file),
+            thumbnail,
+            [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY],
+        )
+
+    # Same steps as the backend's extraction, on the same settings, from the
+    # image decoded for the thumbnails
+    keypoints, descriptors = preprocessing.extract_features(
+        preprocessing.from_color(image)
+    )
+    return keypoints_to_array(keypoints), descriptors
+
+
+def is_processed(name, store, stored, source):
+    if name not in stored:
+        return False
+    previous = store.files[name]
+    if any(previous.get(key) != value for key, value in source.items()):
+        return False
+    stem = Path(name).stem
+    return all(
+        (THUMBNAILS_FOLDER / str(width) / f"{stem}.jpeg").exists()
+        for width in THUMBNAIL_WIDTHS
+    )
+
+
+def open_store(store_dir):
+    try:
+        return FeatureStore.open(store_dir, extractor=preprocessing.extractor())
+    except FeatureStoreError as e:
+        logging.info(f"Not reusing the feature store ({e})")
+        return None
+
+
+def postprocess(store_dir=FEATURE_STORE_DIR, lock_file=STORE_LOCK_FILE, workers=None):
+    # Processes the images that are new or changed since the store was
+    # written and rewrites the store, reusing the features of all others
+    for width in THUMBNAIL_WIDTHS:
+        (THUMBNAILS_FOLDER / str(width)).mkdir(parents=True, exist_ok=True)
+
+    with store_lock(lock_file):
+        store = open_store(store_dir)
+        stored = {}
+        if store is not None:
+            stored = {
+                name: painting for painting, name in enumerate(store.painting_names)
+            }
+
+        sources = {
+            path.name: source_of(path) for path in sorted(IMAGES_FOLDER.glob("*.jpeg"))
+        }
+        pending = {
+            name
+            for name, source in sources.items()
+            if not is_processed(name, store, stored, source)
+        }
+        stats = {"processed": 0, "reused": len(sources) - len(pending), "failed": 0}
+        if not pending and store is not None and len(stored) == len(sources):
+            logging.info("Feature store is up to date")
+            return stats
+        logging.info(f"Processing {len(pending)} of {len(sources)} images")
+
+        with FeatureStoreWriter(
+            store_dir, extractor=preprocessing.extractor()
+        ) as writer:
+            for name, source in sources.items():
+                if name not in pending:
+                    painting = stored[name]
+                    writer.add(
+                        name,
+                        store.painting_keypoints(painting),
+                        store.painting_descriptors(painting),
+                        source=store.files[name],
+                    )
+
+            # Results are written as they come in, not kept in memory
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(process_image, IMAGES_FOLDER / name): name
+                    for name in pending
+                }
+                for future in as_completed(futures):
+                    name = futures[future]
+                    result = future.result()
+                    if result is None:
+                        logging.error(f"Failed to process {name}")
+                        stats["failed"] += 1
+                        continue
+                    keypoints, descriptors = result
+                    source = {
+                        **sources[name],
+                        "sha256": content_hash(IMAGES_FOLDER / name),
+                    }
+                    writer.add(name, keypoints, descriptors, source=source)
+                    stats["processed"] += 1
+                    logging.info(f"Processed {name} ({len(keypoints)} keypoints)")
+
+    logging.info(f"Post-processing finished: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Compute thumbnails and features of the crawled images"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Worker processes, defaults to the CPU count"
+    )
+    args = parser.parse_args()
+    postprocess(workers=args.workers)